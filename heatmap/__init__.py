@@ -3,4 +3,4 @@ try:
 except Exception, e:
     __version__ = 'unknown'
 
-from heatmap import Heatmap
\ No newline at end of file
+from heatmap import Heatmap, Density, RenderStats, SaturationWarning
\ No newline at end of file
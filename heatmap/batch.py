@@ -0,0 +1,177 @@
+"""
+Render many heatmaps on a pool of processes.
+
+Point data and output pixels travel between the parent and the workers in
+shared memory (multiprocessing.sharedctypes), so a job's points are never
+pickled.  The workers inherit the buffers when the pool is started and only
+a job index and its options go over the pool's pipe.
+
+    from heatmap import batch
+    results = batch.render([(pts, {'dotsize': 50}),
+                            (pts2, {'scheme': 'fire'}, 'customer2.png')])
+    results[0].img.save('customer1.png')
+
+On platforms that spawn rather than fork processes (Windows), call render()
+from under an `if __name__ == "__main__":` guard.
+"""
+
+import time
+import ctypes
+import itertools
+import multiprocessing
+from multiprocessing import sharedctypes
+
+from PIL import Image
+
+from heatmap import Heatmap
+
+# jobs staged into shared memory per pool, as a multiple of the pool size.
+# bounds the shared memory held at once for large batches.
+JOBS_PER_PROCESS = 4
+
+
+class JobResult(object):
+    """
+    Outcome of one batch job.
+
+    img      -> the rendered PIL image, or None if the worker wrote a PNG
+    filename -> the PNG written by the worker, or None
+    seconds  -> wall time the worker spent rendering (and saving) the job
+    """
+
+    def __init__(self, img, filename, seconds):
+        self.img = img
+        self.filename = filename
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "<JobResult %s %.3fs>" % (self.filename or self.img,
+                                         self.seconds)
+
+
+# per-process state of a pool worker, set up by _initWorker
+_worker = {}
+
+
+def _initWorker(libpath, points, weights, outputs):
+    _worker['heatmap'] = Heatmap(libpath)
+    _worker['points'] = points
+    _worker['weights'] = weights
+    _worker['outputs'] = outputs
+
+
+def _renderJob(task):
+    """ render a job with Heatmap.heatmap(), so every option it takes
+    works, and save it or copy its pixels to the job's shared output.
+    returns the time taken and, for the parent to rebuild the image, its
+    mode and palette """
+    ndx, options, filename = task
+    start = time.time()
+
+    img = _worker['heatmap'].heatmap(_worker['points'][ndx],
+                                     weights=_worker['weights'][ndx],
+                                     **options)
+    if filename is not None:
+        img.save(filename)
+        return time.time() - start, None, None
+
+    # an RGBA output has room for any mode heatmap() returns
+    data = img.tobytes()
+    ctypes.memmove(_worker['outputs'][ndx], data, len(data))
+    palette = None
+    if img.mode == 'P':
+        palette = (img.getpalette(), img.info.get('transparency'))
+    return time.time() - start, img.mode, palette
+
+
+def render(jobs, processes=None, libpath=None):
+    """
+    Render a batch of heatmaps on a pool of worker processes.
+
+    jobs      -> iterable of (points, options) or (points, options, filename)
+                 tuples.  options is a dict of keyword arguments for
+                 Heatmap.heatmap().  If a filename is given the worker saves
+                 the PNG itself and no image is sent back.
+    processes -> number of worker processes, defaults to the CPU count.
+    libpath   -> path to the heatmap shared library, as for Heatmap().
+
+    Returns a list of JobResult in job order.  A failing job raises its
+    exception here.
+    """
+    hm = Heatmap(libpath)
+    processes = processes or multiprocessing.cpu_count()
+
+    results = []
+    jobs = iter(jobs)
+    while True:
+        chunk = list(itertools.islice(jobs, processes * JOBS_PER_PROCESS))
+        if not chunk:
+            break
+        results.extend(_renderChunk(hm, chunk, len(results), processes,
+                                    libpath))
+    return results
+
+
+def _share(arr):
+    """ copy a ctypes float array into shared memory """
+    shared = sharedctypes.RawArray(ctypes.c_float, len(arr))
+    ctypes.memmove(shared, arr, ctypes.sizeof(shared))
+    return shared
+
+
+def _renderChunk(hm, chunk, first, processes, libpath):
+    """ stage a chunk of jobs into shared memory and render it on a
+    fresh pool, whose workers inherit the buffers """
+
+    points = []
+    weights = []
+    outputs = []
+    tasks = []
+    for ndx, job in enumerate(chunk):
+        options = dict(job[1])
+        filename = None
+        if len(job) > 2:
+            filename = job[2]
+
+        arrPoints, cPoints, arrWeights = hm._convertPoints(
+            job[0], options.pop('weights', None))
+        if cPoints < 2:
+            raise Exception("Job %d has no points." % (first + ndx))
+        points.append(_share(arrPoints))
+        if arrWeights is not None:
+            arrWeights = _share(arrWeights)
+        weights.append(arrWeights)
+
+        out = None
+        if filename is None:
+            size = options.get('size', (1024, 1024))
+            out = sharedctypes.RawArray(ctypes.c_ubyte,
+                                        size[0] * size[1] * 4)
+        outputs.append(out)
+        tasks.append((ndx, options, filename))
+
+    pool = multiprocessing.Pool(min(processes, len(chunk)), _initWorker,
+                                (libpath, points, weights, outputs))
+    try:
+        timings = pool.map(_renderJob, tasks, 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    results = []
+    for (ndx, options, filename), (seconds, mode, palette) in zip(tasks,
+                                                                   timings):
+        img = None
+        if filename is None:
+            size = options.get('size', (1024, 1024))
+            img = Image.frombuffer(mode, (size[0], size[1]), outputs[ndx],
+                                   'raw', mode, 0, 1)
+            if palette is not None:
+                img.putpalette(palette[0])
+                if palette[1] is not None:
+                    img.info['transparency'] = palette[1]
+        results.append(JobResult(img, filename, seconds))
+    return results
@@ -0,0 +1,264 @@
+"""
+Time the render pipeline stage by stage, to catch regressions between
+releases and to compare the engines.
+
+    python -m heatmap.bench --points 1000,100000 --dotsize 25,150 \\
+        --engine stamp,blur -o results.json
+
+Every combination of point count, dotsize, canvas size, distribution and
+engine is rendered runs times and the best time of each stage is kept:
+
+    convertPoints -> Heatmap._convertPoints(), wrapping or copying the points
+    getBounds     -> the C autoscale pass over the points
+    density       -> allocating the density buffer and stamping the points
+    colorize      -> allocating the RGBA buffer and colorizing into it
+    frombuffer    -> Image.frombuffer() over the RGBA buffer
+    savePNG       -> saving that image as PNG with PIL
+    encode        -> Density.encode(), the PNG path of heatmap_bytes()
+
+The results are written as JSON.  Points are generated before the clock
+starts, with numpy if it is installed, which matters from 1e7 points up.
+"""
+
+import sys
+import time
+import json
+import array
+import random
+import platform
+import argparse
+from cStringIO import StringIO
+
+from PIL import Image
+
+from heatmap import Heatmap, Density
+
+STAGES = ("convertPoints", "getBounds", "density", "colorize", "frombuffer",
+          "savePNG", "encode")
+# the stages heatmap() goes through; encode is the alternative to the last
+# three
+PIPELINE = STAGES[:-1]
+DISTRIBUTIONS = ("uniform", "clustered", "line")
+
+# points are generated in the unit square and rendered with it as the area,
+# so every distribution covers the same canvas
+AREA = ((0, 0), (1, 1))
+CLUSTERS = 10
+CLUSTER_SIGMA = 0.02
+
+
+def makePoints(count, distribution="uniform", seed=0):
+    """
+    count float32 x,y pairs in the unit square, as a flat buffer.
+
+    uniform   -> spread evenly over the square
+    clustered -> gaussian blobs around a few random centers
+    line      -> a vertical line down the middle, as in the
+                 test_heatmap_vert_line test
+    """
+    if distribution not in DISTRIBUTIONS:
+        raise Exception("Unknown distribution: %s.  Available: %s" % (
+            distribution, DISTRIBUTIONS))
+    try:
+        import numpy
+    except ImportError:
+        return _makePoints(count, distribution, seed)
+
+    rand = numpy.random.RandomState(seed)
+    if distribution == "uniform":
+        pts = rand.random_sample((count, 2))
+    elif distribution == "clustered":
+        centers = rand.random_sample((CLUSTERS, 2))
+        pts = centers[rand.randint(0, CLUSTERS, count)]
+        pts += rand.normal(0, CLUSTER_SIGMA, (count, 2))
+    else:
+        pts = numpy.empty((count, 2))
+        pts[:, 0] = 0.5
+        pts[:, 1] = rand.random_sample(count)
+    return pts.astype(numpy.float32)
+
+
+def _makePoints(count, distribution, seed):
+    """ makePoints() without numpy, a few seconds per million points """
+    rand = random.Random(seed)
+    if distribution == "uniform":
+        return array.array('f', [rand.random() for x in xrange(count * 2)])
+    pts = array.array('f')
+    if distribution == "clustered":
+        centers = [(rand.random(), rand.random()) for x in range(CLUSTERS)]
+        for x in xrange(count):
+            cx, cy = centers[rand.randrange(CLUSTERS)]
+            pts.append(rand.gauss(cx, CLUSTER_SIGMA))
+            pts.append(rand.gauss(cy, CLUSTER_SIGMA))
+    else:
+        for x in xrange(count):
+            pts.append(0.5)
+            pts.append(rand.random())
+    return pts
+
+
+def timeStages(hm, points, dotsize=150, size=(1024, 1024), engine="stamp",
+               scheme="classic", opacity=128, runs=3):
+    """
+    Best time in seconds of each of STAGES over runs renders of points, as
+    a dict.  points can be anything Heatmap.heatmap() takes; pass a list of
+    tuples to time the conversion of one.
+    """
+    best = dict([(stage, None) for stage in STAGES])
+
+    def timed(stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best[stage] is None or elapsed < best[stage]:
+            best[stage] = elapsed
+        return result
+
+    width, height = size
+    for x in range(runs):
+        arrPoints, cPoints, arrWeights = timed("convertPoints",
+                                               hm._convertPoints, points)
+        timed("getBounds", hm._bounds, arrPoints, cPoints)
+
+        def stamp():
+            d = Density(hm, size, dotsize, AREA, engine=engine)
+            d._add(arrPoints, cPoints, arrWeights)
+            return d
+        d = timed("density", stamp)
+
+        def colorize():
+            arrFinalImage = hm._allocOutputBuffer(size)
+            d._colorize(scheme, opacity, arrFinalImage)
+            return arrFinalImage
+        arrFinalImage = timed("colorize", colorize)
+
+        img = timed("frombuffer", Image.frombuffer, 'RGBA', (width, height),
+                    arrFinalImage, 'raw', 'RGBA', 0, 1)
+        timed("savePNG", img.save, StringIO(), "PNG")
+        timed("encode", d.encode, scheme, opacity)
+    return best
+
+
+def sweep(hm, counts, dotsizes=(150,), sizes=((1024, 1024),),
+          distributions=DISTRIBUTIONS, engines=("stamp",), runs=3,
+          tuples=False, log=None):
+    """
+    timeStages() over every combination of the arguments.  Returns a list
+    of results, one dict per combination holding its parameters, the
+    stage times and the total of the PIPELINE stages.  With tuples, the
+    points are passed as a list of (x, y) tuples instead of a buffer.  log,
+    if given, is called with each result as it is done.
+    """
+    results = []
+    for count in counts:
+        for distribution in distributions:
+            points = makePoints(count, distribution)
+            if tuples:
+                flat = array.array('f', str(buffer(points)))
+                points = zip(flat[0::2], flat[1::2])
+            for size in sizes:
+                for dotsize in dotsizes:
+                    for engine in engines:
+                        stages = timeStages(hm, points, dotsize, size, engine,
+                                            runs=runs)
+                        result = {'points': count,
+                                  'distribution': distribution,
+                                  'size': list(size),
+                                  'dotsize': dotsize,
+                                  'engine': engine,
+                                  'input': tuples and "tuples" or "buffer",
+                                  'stages': stages,
+                                  'total': sum([stages[stage] for stage
+                                                in PIPELINE])}
+                        results.append(result)
+                        if log is not None:
+                            log(result)
+            del points
+    return results
+
+
+def _ints(text):
+    # accept 1e6 as well as 1000000
+    return [int(float(v)) for v in text.split(",")]
+
+
+def _sizes(text):
+    sizes = []
+    for v in text.split(","):
+        if "x" in v:
+            width, height = v.split("x")
+        else:
+            width = height = v
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def _names(choices):
+    def parse(text):
+        names = text.split(",")
+        for name in names:
+            if name not in choices:
+                raise argparse.ArgumentTypeError(
+                    "unknown %s, choose from %s" % (name, ", ".join(choices)))
+        return names
+    return parse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m heatmap.bench",
+        description="Time each stage of the heatmap render pipeline and "
+                    "write the results as JSON.")
+    parser.add_argument("--points", type=_ints,
+                        default=[1000, 10000, 100000, 1000000],
+                        help="point counts, e.g. 1e3,1e6,1e8")
+    parser.add_argument("--dotsize", type=_ints, default=[25, 150],
+                        help="dotsizes in pixels")
+    parser.add_argument("--size", type=_sizes, default=[(1024, 1024)],
+                        help="canvas sizes, e.g. 256,1024x768")
+    parser.add_argument("--distribution", type=_names(DISTRIBUTIONS),
+                        default=list(DISTRIBUTIONS),
+                        help="point distributions: %s" %
+                             ", ".join(DISTRIBUTIONS))
+    parser.add_argument("--engine", type=_names(sorted(Density.ENGINES)),
+                        default=["stamp"], help="density engines: %s" %
+                                                ", ".join(sorted(Density.ENGINES)))
+    parser.add_argument("--runs", type=int, default=3,
+                        help="renders per combination; the best is kept")
+    parser.add_argument("--tuples", action="store_true",
+                        help="pass the points as a list of tuples")
+    parser.add_argument("--libpath",
+                        help="heatmap shared library to time, e.g. an older "
+                             "build")
+    parser.add_argument("-o", "--output",
+                        help="file to write the JSON to, default stdout")
+    args = parser.parse_args(argv)
+
+    def log(result):
+        sys.stderr.write("%9d %-9s %9s dotsize %3d %-6s %8.3fs\n" % (
+            result['points'], result['distribution'],
+            "x".join(map(str, result['size'])), result['dotsize'],
+            result['engine'], result['total']))
+
+    hm = Heatmap(args.libpath)
+    results = sweep(hm, args.points, args.dotsize, args.size,
+                    args.distribution, args.engine, args.runs, args.tuples,
+                    log)
+
+    # the package, not the heatmap module next to this one
+    package = __import__('heatmap', level=0)
+    report = {'heatmap': package.__version__,
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'platform': platform.platform(),
+              'stages': STAGES,
+              'results': results}
+    out = sys.stdout
+    if args.output:
+        out = file(args.output, "w")
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Cache rendered heatmaps by a fingerprint of what they were rendered from.
+
+    from heatmap import cache
+    renders = cache.RenderCache(cacheDir="/var/cache/heatmap")
+    img = renders.heatmap(pts, dotsize=40, scheme="fire")
+    png = renders.png(pts, dotsize=40, scheme="fire")
+
+The key of a render is a 64 bit hash of the float32 points (and weights)
+computed by the C code, plus the options that change the image and the
+colors of the scheme.  Hashing runs at memory speed, so a hit costs a
+fraction of a render; points given as a list of tuples still have to be
+converted first, so pass buffers where that matters.  Renders are kept in
+memory in a least recently used cache bounded by bytes and, if cacheDir is
+given, as PNGs on disk for other processes to reuse.  Renders with a
+projection function aren't cached, since the key can't tell two functions
+apart.
+"""
+
+import os
+import ctypes
+import inspect
+import hashlib
+import threading
+import collections
+from cStringIO import StringIO
+
+from PIL import Image
+
+import colorschemes
+from heatmap import Heatmap
+
+
+class LRUCache(object):
+    """
+    Least recently used cache of byte strings, holding at most maxBytes
+    of them.  Safe to share between threads.
+    """
+
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ the value stored under key, or None """
+        with self._lock:
+            data = self._items.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # re-inserting moves it to the most recently used end
+            self._items[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """ store a value, evicting the least recently used ones to make
+        room.  values bigger than the whole cache aren't stored """
+        if len(data) > self.maxBytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            while self.bytes + len(data) > self.maxBytes:
+                self.bytes -= len(self._items.popitem(last=False)[1])
+            self._items[key] = data
+            self.bytes += len(data)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _atomicWrite(path, data):
+    """ write data to path for a disk cache, making its directory,
+    atomically so that concurrent readers never see half a file.  failures
+    are ignored: the data is still cached in memory """
+    tmp = "%s.%d.%d.tmp" % (path, os.getpid(),
+                            threading.current_thread().ident)
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        file(tmp, "wb").write(data)
+        os.rename(tmp, path)
+    except (OSError, IOError):
+        # another process made the directory first, or the disk is full
+        pass
+
+
+def _defaults(func):
+    """ the default values of the keyword arguments of func """
+    spec = inspect.getargspec(func)
+    return dict(zip(spec.args[::-1], (spec.defaults or ())[::-1]))
+
+
+class RenderCache(object):
+    """
+    Cache in front of Heatmap.heatmap().
+
+    hm       -> Heatmap to render with, or None to load one from libpath
+    maxBytes -> size of the in-memory cache
+    cacheDir -> directory to keep rendered PNGs in, or None for none
+    libpath  -> path to the heatmap shared library, as for Heatmap()
+
+    A RenderStats passed as stats is only filled in by a render: a hit
+    leaves it as it was, so check stats() for what was served from the
+    cache.
+    """
+
+    # options of Heatmap.heatmap() that don't change the image, left out of
+    # the key
+    UNKEYED = ('stats', 'threads')
+    # options left out are keyed as their defaults, so passing one at its
+    # default is the same render
+    DEFAULTS = _defaults(Heatmap.heatmap)
+
+    def __init__(self, hm=None, maxBytes=256 * 1024 * 1024, cacheDir=None,
+                 libpath=None):
+        self.hm = hm or Heatmap(libpath)
+        self.cache = LRUCache(maxBytes)
+        self.cacheDir = cacheDir
+        self.diskHits = 0
+        self.renders = 0
+        self._lock = threading.Lock()
+
+        fp = self.hm._heatmap.fingerprint
+        fp.restype = ctypes.c_ulonglong
+        fp.argtypes = [ctypes.c_void_p, ctypes.c_longlong, ctypes.c_ulonglong]
+
+    def fingerprint(self, points, weights=None, **options):
+        """
+        Key of the render of points with options, as a string of hex
+        digits.  Takes the same arguments as Heatmap.heatmap().  Returns
+        the key and the converted points and weights.  A scheme
+        re-registered with different colors gets a different key.  Renders
+        with a projection function can't be keyed by what it computes, so
+        they have no key and raise an Exception.
+        """
+        if callable(options.get('projection')):
+            raise Exception("Renders with a projection function aren't "
+                            "cached.")
+        arrPoints, cPoints, arrWeights = self.hm._convertPoints(points,
+                                                                weights)
+        fp = self.hm._heatmap.fingerprint
+        h = fp(arrPoints, ctypes.sizeof(arrPoints), 0)
+        if arrWeights is not None:
+            h = fp(arrWeights, ctypes.sizeof(arrWeights), h)
+
+        keyed = dict(self.DEFAULTS)
+        keyed.update(options)
+        for name in self.UNKEYED + ('points', 'weights'):
+            keyed.pop(name, None)
+        digest = hashlib.sha1(repr(sorted(keyed.items())))
+        scheme = keyed['scheme']
+        if scheme in colorschemes.schemes:
+            digest.update(colorschemes.rgb(scheme))
+        key = "%016x-%s" % (h, digest.hexdigest()[:16])
+        return key, arrPoints, arrWeights
+
+    def heatmap(self, points, weights=None, **options):
+        """
+        The image Heatmap.heatmap() would render, from the cache if it was
+        rendered before.  Takes the same arguments as Heatmap.heatmap().
+        Every call returns a new image, which can be modified freely.
+        Renders with a projection function are passed straight through.
+        stats is only filled in when the image is rendered, not on a hit.
+        """
+        if callable(options.get('projection')):
+            return self._render(points, weights, options)
+        if options.get('palette'):
+            # palette images are cached as their PNG, which keeps the
+            # palette and transparency, and is small and quick to decode
+            img = Image.open(StringIO(self.png(points, weights, **options)))
+            img.load()
+            return img
+
+        key, arrPoints, arrWeights = self.fingerprint(points, weights,
+                                                      **options)
+        size = options.get('size', (1024, 1024))
+        pixels = self.cache.get(("rgba", key))
+        if pixels is None:
+            png = self._fromDisk(key)
+            if png is not None:
+                pixels = Image.open(StringIO(png)).convert('RGBA').tobytes()
+            else:
+                img = self._render(arrPoints, arrWeights, options)
+                if self.cacheDir is not None:
+                    self._encode(key, img)
+                pixels = img.tobytes()
+            self.cache.put(("rgba", key), pixels)
+        return Image.frombytes('RGBA', (size[0], size[1]), pixels)
+
+    def png(self, points, weights=None, **options):
+        """
+        The image Heatmap.heatmap() would render, encoded as PNG, from the
+        cache if it was rendered before.  Takes the same arguments as
+        Heatmap.heatmap().  Renders with a projection function are
+        rendered every time.  stats is only filled in when the image is
+        rendered, not on a hit.
+        """
+        if callable(options.get('projection')):
+            return self._encode(None, self._render(points, weights, options))
+        key, arrPoints, arrWeights = self.fingerprint(points, weights,
+                                                      **options)
+        png = self.cache.get(("png", key))
+        if png is None:
+            png = self._fromDisk(key)
+            if png is None:
+                img = self._render(arrPoints, arrWeights, options)
+                png = self._encode(key, img)
+            self.cache.put(("png", key), png)
+        return png
+
+    def _render(self, arrPoints, arrWeights, options):
+        img = self.hm.heatmap(arrPoints, weights=arrWeights, **options)
+        with self._lock:
+            self.renders += 1
+        return img
+
+    def _encode(self, key, img):
+        """ PNG of img, saved to the disk cache under key if there is one
+        and a key """
+        out = StringIO()
+        img.save(out, "PNG")
+        png = out.getvalue()
+        if self.cacheDir is not None and key is not None:
+            self._save(key, png)
+        return png
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key + ".png")
+
+    def _fromDisk(self, key):
+        if self.cacheDir is None:
+            return None
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        with self._lock:
+            self.diskHits += 1
+        return file(path, "rb").read()
+
+    def _save(self, key, png):
+        """ write a PNG to the disk cache """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            _atomicWrite(path, png)
+
+    def stats(self):
+        """
+        Cache counters:
+
+        hits, misses -> lookups in the memory cache
+        hitRate      -> hits / lookups, or None before the first lookup
+        diskHits     -> misses found in the disk cache
+        renders      -> heatmaps rendered
+        bytes        -> size of the memory cache
+        entries      -> number of images and PNGs in the memory cache
+        """
+        with self._lock:
+            lookups = self.cache.hits + self.cache.misses
+            hitRate = None
+            if lookups:
+                hitRate = float(self.cache.hits) / lookups
+            return {'hits': self.cache.hits,
+                    'misses': self.cache.misses,
+                    'hitRate': hitRate,
+                    'diskHits': self.diskHits,
+                    'renders': self.renders,
+                    'bytes': self.cache.bytes,
+                    'entries': len(self.cache)}
@@ -1281,6 +1281,57 @@ schemes = {'classic': [(255, 237, 237),
              (51, 52, 51),
              (51, 52, 51)]}
 
+# packed lookup tables built from schemes, by (kind, name[, opacity])
+_luts = {}
+
 def valid_schemes():
     return schemes.keys()
 
+def register(name, colors):
+    """
+    Add a color scheme, or replace one.  colors is a list of 256 (r, g, b)
+    tuples of ints in 0..255, from the densest level to the emptiest.
+    """
+    colors = [tuple(color) for color in colors]
+    if len(colors) != 256:
+        raise Exception("A color scheme needs 256 colors, got %d." % len(colors))
+    for color in colors:
+        if len(color) != 3 or [v for v in color
+                               if not isinstance(v, int) or not 0 <= v <= 255]:
+            raise Exception("Invalid color in scheme %s: %r" % (name, color))
+    schemes[name] = colors
+    for key in _luts.keys():
+        if key[1] == name:
+            _luts.pop(key, None)
+
+def rgb(name):
+    """ the scheme packed into a string of 768 bytes, r, g, b for each
+    density level.  built once and reused """
+    lut = _luts.get(('rgb', name))
+    if lut is None:
+        lut = "".join([chr(r) + chr(g) + chr(b) for r, g, b in schemes[name]])
+        _luts[('rgb', name)] = lut
+    return lut
+
+def rgba(name, opacity):
+    """ the scheme packed into a string of 1024 bytes, r, g, b, a for each
+    density level, with the alpha of alpha(opacity) baked in.  built once
+    per opacity and reused """
+    lut = _luts.get(('rgba', name, opacity))
+    if lut is None:
+        colors = rgb(name)
+        alphas = alpha(opacity)
+        lut = "".join([colors[level*3:level*3+3] + alphas[level]
+                       for level in range(256)])
+        _luts[('rgba', name, opacity)] = lut
+    return lut
+
+def alpha(opacity):
+    """ the alpha of each density level, as a string of 256 bytes: opacity,
+    except for the emptiest levels (> 252) which are transparent.  the
+    transparency table of palette images """
+    lut = _luts.get(('alpha', None, opacity))
+    if lut is None:
+        lut = chr(opacity & 0xff) * 253 + '\x00' * 3
+        _luts[('alpha', None, opacity)] = lut
+    return lut
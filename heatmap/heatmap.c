@@ -3,6 +3,25 @@
 #include <math.h>
 #include <string.h>
 
+// status of the last call on a struct info
+#define STATUS_OK 0
+#define STATUS_INVALID 1        // bad parameters, nothing was done
+#define STATUS_NO_MEMORY 2      // an allocation failed, nothing was done
+#define STATUS_SATURATED 3      // colorized, but over 80% of the pixels are
+                                // over 95% density
+
+// what the native code found, handed back in struct info instead of being
+// printed
+struct result
+{
+	int status;
+	// points stamped so far whose center fell outside the area
+	int clipped;
+	// pixels at each density level, as of the last colorize or
+	// countLevels.  level 0xff is empty, below 0x10 is saturated.
+	int histogram[256];
+};
+
 struct info
 {
 	float minX;
@@ -13,8 +32,28 @@ struct info
 	int width;
 	int height;
 	int dotsize;
+	int threads;
+	int engine;
+	int projection;
+
+	// the pixels stamped so far: columns dirty[0] to dirty[2] - 1 of rows
+	// dirty[1] to dirty[3] - 1.  empty while dirty[2] <= dirty[0].
+	int dirty[4];
+
+	struct result result;
 };
 
+#define ENGINE_STAMP 0
+#define ENGINE_BINNED 1
+#define ENGINE_BLUR 2
+
+#define PROJ_LINEAR 0
+#define PROJ_WEB_MERCATOR 1
+
+// web mercator is cut off at this latitude, which makes the world square
+#define MAX_LAT 85.0511287798
+#define PI 3.14159265358979323846
+
 struct point {
     float x;
     float y;
@@ -30,25 +69,47 @@ BOOL WINAPI DllMain(    HINSTANCE hinstDLL,  // handle to DLL module
 {
     return TRUE;
 }
+#else
+#include <pthread.h>
 #endif
 
-//walk the list of points, get the boundary values    
+// a float that is neither NaN nor infinite: either makes v - v NaN
+#define FINITE(v) ((v) - (v) == 0.f)
+
+//walk the list of points, get the boundary values.  points with a NaN or
+//infinite coordinate are skipped; without any finite point the bounds are
+//all 0 and the status is STATUS_INVALID.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
 void getBounds(struct info *inf, float *points, unsigned int cPoints)
 {
     unsigned int i = 0;
+    float minX = 0.f;
+    float minY = 0.f;
+    float maxX = 0.f;
+    float maxY = 0.f;
 
-    // first init the global counts
-    float minX = points[i];
-    float minY = points[i+1];
-    float maxX = points[i];
-    float maxY = points[i+1];
+    // first init the global counts from the first finite point
+    for (i = 0; i + 1 < cPoints; i=i+2)
+    {
+        if (FINITE(points[i]) && FINITE(points[i+1])) break;
+    }
+    inf->result.status = i + 1 < cPoints ? STATUS_OK : STATUS_INVALID;
+    if (i + 1 < cPoints)
+    {
+        minX = maxX = points[i];
+        minY = maxY = points[i+1];
+    }
 
     //then iterate over the list and find the max/min values
-    for(i = 0; i < cPoints; i=i+2)
+    for(; i + 1 < cPoints; i=i+2)
     {
         float x = points[i];
         float y = points[i+1];
 
+        if (!(FINITE(x) && FINITE(y))) continue;
+
         if (x > maxX) maxX = x;
         if (x < minX) minX = x;
 
@@ -64,7 +125,223 @@ void getBounds(struct info *inf, float *points, unsigned int cPoints)
     return;
 }
 
-//transform from dataset coordinates into image coordinates
+// the quantiles are found by radix select over the bits of the floats:
+// each pass histograms the bits from SKETCH_SHIFT[pass] up of the points
+// whose bits in SKETCH_TOP[pass] match the bins the quantile fell in so
+// far, so the last pass lands on the exact float whatever the range.
+#define SKETCH_BINS 4096
+#define SKETCH_PASSES 3
+static const int SKETCH_SHIFT[SKETCH_PASSES] = {20, 8, 0};
+static const unsigned int SKETCH_TOP[SKETCH_PASSES] =
+    {0x00000000, 0xfff00000, 0xffffff00};
+
+// one quantile being refined: the float at rank has the bits of prefix
+// above those the next pass looks at
+struct sketch
+{
+    unsigned int prefix;
+    long long below;    // values sorting under prefix seen this pass
+    long long rank;
+    int *hist;
+};
+
+// the bits of a float as an unsigned int that sorts the same way the
+// floats do, and back
+static unsigned int floatKey(float v)
+{
+    unsigned int u = 0;
+
+    memcpy(&u, &v, sizeof(u));
+    return (u & 0x80000000) ? ~u : u | 0x80000000;
+}
+
+static float keyFloat(unsigned int key)
+{
+    float v = 0.f;
+
+    key = (key & 0x80000000) ? key & 0x7fffffff : ~key;
+    memcpy(&v, &key, sizeof(v));
+    return v;
+}
+
+static void sketchAdd(struct sketch *sk, unsigned int key, int pass)
+{
+    unsigned int top = key & SKETCH_TOP[pass];
+
+    if (top < sk->prefix)
+    {
+        sk->below++;
+        return;
+    }
+    if (top > sk->prefix) return;
+    sk->hist[(key & ~SKETCH_TOP[pass]) >> SKETCH_SHIFT[pass]]++;
+}
+
+//getBounds, clipped to the low and high quantiles (0 to 1) of the x and y
+//coordinates of the finite points, so a few outliers or junk points don't
+//shrink the rest into a corner.  all four quantiles are refined in the same
+//pass over the points, in fixed memory, and the first pass also counts the
+//finite points, so it is one pass for the bounds and SKETCH_PASSES to find
+//the exact quantiles, however far out the junk is.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int getBoundsClipped(struct info *inf, float *points, unsigned int cPoints,
+                     float low, float high)
+{
+    struct sketch sk[4];
+    int *hist = NULL;
+    long long count = 0;
+    long long seen = 0;
+    unsigned int i = 0;
+    int pass = 0;
+    int bin = 0;
+    int k = 0;
+
+    if (NULL == inf) return 0;
+    if (NULL == points || !(low >= 0.f && low < high && high <= 1.f))
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    getBounds(inf, points, cPoints);
+    if (STATUS_OK != inf->result.status) return 0;
+    if (0.f == low && 1.f == high) return 1;
+
+    hist = (int *)malloc(4 * SKETCH_BINS * sizeof(int));
+    if (NULL == hist)
+    {
+        inf->result.status = STATUS_NO_MEMORY;
+        return 0;
+    }
+
+    memset(sk, 0, sizeof(sk));
+    for (k = 0; k < 4; k++)
+        sk[k].hist = hist + k * SKETCH_BINS;
+
+    for (pass = 0; pass < SKETCH_PASSES; pass++)
+    {
+        // both quantiles of an axis share the first histogram
+        for (k = 0; k < 4; k++)
+        {
+            if (0 == pass && k % 2) continue;
+            memset(sk[k].hist, 0, SKETCH_BINS * sizeof(int));
+            sk[k].below = 0;
+        }
+
+        for (i = 0; i + 1 < cPoints; i=i+2)
+        {
+            unsigned int x = 0;
+            unsigned int y = 0;
+
+            if (!(FINITE(points[i]) && FINITE(points[i+1]))) continue;
+            x = floatKey(points[i]);
+            y = floatKey(points[i+1]);
+            if (0 == pass)
+            {
+                count++;
+                sk[0].hist[x >> SKETCH_SHIFT[0]]++;
+                sk[2].hist[y >> SKETCH_SHIFT[0]]++;
+                continue;
+            }
+            sketchAdd(&sk[0], x, pass);
+            sketchAdd(&sk[1], x, pass);
+            sketchAdd(&sk[2], y, pass);
+            sketchAdd(&sk[3], y, pass);
+        }
+
+        if (0 == pass)
+        {
+            for (k = 0; k < 4; k++)
+            {
+                if (k % 2)
+                    memcpy(sk[k].hist, sk[k & 2].hist, SKETCH_BINS * sizeof(int));
+                sk[k].rank = (long long)((k % 2 ? high : low) * (count - 1));
+            }
+        }
+
+        for (k = 0; k < 4; k++)
+        {
+            seen = sk[k].below;
+            for (bin = 0; bin < SKETCH_BINS - 1; bin++)
+            {
+                if (seen + sk[k].hist[bin] > sk[k].rank) break;
+                seen += sk[k].hist[bin];
+            }
+            sk[k].prefix |= (unsigned int)bin << SKETCH_SHIFT[pass];
+        }
+    }
+    free(hist);
+
+    inf->minX = keyFloat(sk[0].prefix);
+    inf->maxX = keyFloat(sk[1].prefix);
+    inf->minY = keyFloat(sk[2].prefix);
+    inf->maxY = keyFloat(sk[3].prefix);
+    return 1;
+}
+
+//copy the points with finite coordinates (and a finite weight, if there
+//are weights) to outPoints and outWeights, which have room for all of
+//them.  returns the number of floats copied to outPoints.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int compactFinite(float *points, float *weights, int cPoints,
+                  float *outPoints, float *outWeights)
+{
+    int kept = 0;
+    int i = 0;
+
+    if (NULL == points || NULL == outPoints || cPoints < 0 ||
+        (NULL != weights && NULL == outWeights))
+        return -1;
+
+    for (i = 0; i + 1 < cPoints; i=i+2)
+    {
+        if (!(FINITE(points[i]) && FINITE(points[i+1]))) continue;
+        if (NULL != weights)
+        {
+            if (!FINITE(weights[i/2])) continue;
+            outWeights[kept/2] = weights[i/2];
+        }
+        outPoints[kept] = points[i];
+        outPoints[kept+1] = points[i+1];
+        kept += 2;
+    }
+    return kept;
+}
+
+//grow a dirty rectangle to cover columns x0..x1-1 of rows y0..y1-1
+void growDirty(int *dirty, int x0, int y0, int x1, int y1)
+{
+    if (x1 <= x0 || y1 <= y0) return;
+    if (dirty[2] <= dirty[0])
+    {
+        dirty[0] = x0;
+        dirty[1] = y0;
+        dirty[2] = x1;
+        dirty[3] = y1;
+        return;
+    }
+    if (x0 < dirty[0]) dirty[0] = x0;
+    if (y0 < dirty[1]) dirty[1] = y0;
+    if (x1 > dirty[2]) dirty[2] = x1;
+    if (y1 > dirty[3]) dirty[3] = y1;
+}
+
+//web mercator y of a latitude in degrees, from -PI at the bottom of the
+//map to PI at the top
+double mercY(double lat)
+{
+    if (lat > MAX_LAT) lat = MAX_LAT;
+    if (lat < -MAX_LAT) lat = -MAX_LAT;
+    return log(tan(PI / 4 + lat * PI / 360.0));
+}
+
+//transform from dataset coordinates into image coordinates.  with a
+//projection other than linear, minY and maxY must already be projected,
+//see stampPoints.
 struct point translate(struct info *inf, struct point pt)
 {
     float minX = inf->minX;
@@ -75,6 +352,9 @@ struct point translate(struct info *inf, struct point pt)
     int width = inf->width;
     int height = inf->height;
        
+    if (PROJ_WEB_MERCATOR == inf->projection)
+        pt.y = (float)mercY(pt.y);
+
     // normalize the point into range 0..1
     pt.x = (pt.x - minX) / (maxX - minX);
     pt.y = (pt.y - minY) / (maxY - minY);
@@ -86,103 +366,1191 @@ struct point translate(struct info *inf, struct point pt)
     return pt;
 }
 
-unsigned char* calcDensity(struct info *inf, float *points, int cPoints)
+//latitude in degrees of a web mercator y, the inverse of mercY.  ys past
+//the clamped top or bottom of the map stand for every latitude beyond it.
+double mercLat(double y)
 {
-    int width = inf->width;
-    int height = inf->height;
-    int dotsize = inf->dotsize;
-    
-    unsigned char* pixels = (unsigned char *)calloc(width*height, sizeof(char)); 
+    if (y >= mercY(MAX_LAT)) return HUGE_VAL;
+    if (y <= mercY(-MAX_LAT)) return -HUGE_VAL;
+    return (atan(exp(y)) - PI / 4) * 360.0 / PI;
+}
+
+// a rectangle of coordinates, inclusive, see reachBox
+struct box
+{
+    float minX;
+    float minY;
+    float maxX;
+    float maxY;
+};
+
+//the rectangle of dataset coordinates that translate into rows y0..y1 of
+//the image, all columns, widened by margin pixels on every side.  points
+//outside it are skipped by comparing their raw coordinates, without
+//translating them first; with margin at least the reach of a dot plus a
+//pixel of slack for rounding, none of them could have drawn anything.
+//with translated, the points are already in image coordinates.
+struct box reachBox(struct info *inf, int y0, int y1, float margin,
+                    int translated)
+{
+    struct box b;
+    double sx = (inf->maxX - (double)inf->minX) / inf->width;
+    double sy = (inf->maxY - (double)inf->minY) / inf->height;
+    double x[2];
+    double y[2];
 
+    if (translated)
+    {
+        b.minX = -margin;
+        b.maxX = inf->width + margin;
+        b.minY = y0 - margin;
+        b.maxY = y1 + margin;
+        return b;
+    }
+
+    x[0] = inf->minX - margin * sx;
+    x[1] = inf->minX + (inf->width + margin) * sx;
+    // image rows run from the top of the area down
+    y[0] = inf->maxY - (y1 + margin) * sy;
+    y[1] = inf->maxY - (y0 - margin) * sy;
+    if (PROJ_WEB_MERCATOR == inf->projection)
+    {
+        y[0] = mercLat(y[0]);
+        y[1] = mercLat(y[1]);
+    }
+
+    // an area given with max < min flips the axis
+    b.minX = (float)(x[0] < x[1] ? x[0] : x[1]);
+    b.maxX = (float)(x[0] < x[1] ? x[1] : x[0]);
+    b.minY = (float)(y[0] < y[1] ? y[0] : y[1]);
+    b.maxY = (float)(y[0] < y[1] ? y[1] : y[0]);
+    return b;
+}
+
+#define IN_BOX(b, x, y) \
+    ((x) >= (b).minX && (x) <= (b).maxX && (y) >= (b).minY && (y) <= (b).maxY)
+
+// sub-pixel positions per axis that get their own precomputed stamp.  the
+// falloff gets steeper as dots shrink, so small dots need finer steps to
+// stay within a density level or so of the exact distance.
+#define MIN_SUBPIX 4
+#define MAX_SUBPIX 32
+
+// the falloff pattern of a dot only depends on dotsize and where the point
+// falls inside its pixel, so it is computed once per render instead of once
+// per pixel of every dot.
+struct stamp
+{
+    int size;               // stamps are size x size pixels
+    int half;               // offset from stamp origin to the dot's pixel
+    int subpix;             // sub-pixel positions per axis
+    unsigned char *vals;    // subpix*subpix stamps of pixVal multipliers
+    int *spans;             // per stamp row: first and last+1 column != 255
+};
+
+int buildStamp(struct stamp *st, int dotsize)
+{
     float midpt = dotsize / 2.f;
     double radius = sqrt(midpt*midpt + midpt*midpt) / 2.f;
+    double cx = 0.0;
+    double cy = 0.0;
     double dist = 0.0;
     int pixVal = 0;
-    int j = 0;
-    int k = 0;
+    int s = 0;
+    int u = 0;
+    int v = 0;
+    unsigned char *row = NULL;
+    int *span = NULL;
+
+    int subpix = (256 + dotsize - 1) / dotsize;
+
+    if (subpix < MIN_SUBPIX) subpix = MIN_SUBPIX;
+    if (subpix > MAX_SUBPIX) subpix = MAX_SUBPIX;
+
+    st->size = dotsize;
+    st->half = dotsize / 2;
+    st->subpix = subpix;
+    st->vals = (unsigned char *)malloc(subpix*subpix * dotsize*dotsize);
+    st->spans = (int *)malloc(subpix*subpix * dotsize * 2 * sizeof(int));
+    if (NULL == st->vals || NULL == st->spans)
+    {
+        free(st->vals);
+        free(st->spans);
+        return 0;
+    }
+
+    for (s = 0; s < subpix*subpix; s++)
+    {
+        // dot center relative to the stamp origin, at the middle of
+        // this sub-pixel cell
+        cx = st->half + ((s % subpix) + 0.5) / subpix;
+        cy = st->half + ((s / subpix) + 0.5) / subpix;
+
+        for (v = 0; v < dotsize; v++)
+        {
+            row = st->vals + (s*dotsize + v) * dotsize;
+            span = st->spans + (s*dotsize + v) * 2;
+            span[0] = dotsize;
+            span[1] = 0;
+
+            for (u = 0; u < dotsize; u++)
+            {
+                dist = sqrt( (u-cx)*(u-cx) + (v-cy)*(v-cy) );
+
+                pixVal = (int)(200.0*(dist/radius)+50.0);
+                if (pixVal > 255) pixVal = 255;
+                row[u] = (unsigned char)pixVal;
+
+                // 255 leaves a pixel unchanged, only walk the rest
+                if (pixVal < 255)
+                {
+                    if (u < span[0]) span[0] = u;
+                    span[1] = u + 1;
+                }
+            }
+        }
+    }
+
+    return 1;
+}
+
+void freeStamp(struct stamp *st)
+{
+    free(st->vals);
+    free(st->spans);
+    st->vals = NULL;
+    st->spans = NULL;
+}
+
+// a horizontal slice of the image, stamped by one thread.  every band
+// walks the whole point list in order and only touches its own rows, so
+// bands never share a pixel and each pixel sees the same sequence of
+// multiplies as in a single-threaded render.
+struct band
+{
+    struct info *inf;
+    struct stamp *st;
+    float *points;
+    float *weights;         // one per point, or NULL for all 1
+    int cPoints;
+    unsigned char *pixels;  // multiply into 8-bit density, or
+    float *acc;             // add kernel weights into a float buffer
+    unsigned char *powTables; // multiply mode, see buildPowTables
+    int translated;         // points are already in image coordinates
+    int rowStart;
+    int rowEnd;
+    int dirty[4];           // pixels this band stamped, as in struct info
+    int clipped;            // points off the image, counted by the top band
+};
+
+// multiply mode raises pixVal/255 to the power of a point's weight through
+// a lookup table.  weights are quantized to POW_STEPS levels per doubling,
+// which puts every table entry within a fraction of a density level of the
+// exact power, so the number of tables is bounded however many distinct
+// weights there are.  weights beyond 2^POW_OCTAVES either way are clamped.
+#define POW_STEPS 256
+#define POW_OCTAVES 16
+#define POW_LEVELS (2 * POW_OCTAVES * POW_STEPS + 1)
+
+int powLevel(float weight)
+{
+    double level = floor(log(weight) / log(2.0) * POW_STEPS + 0.5);
+
+    level += POW_OCTAVES * POW_STEPS;
+    if (level < 0) return 0;
+    if (level >= POW_LEVELS) return POW_LEVELS - 1;
+    return (int)level;
+}
+
+//the pow tables of the levels the weights use, POW_LEVELS tables of 256
+//with only those filled in, or NULL if out of memory.  built once per
+//render and shared by the bands.
+unsigned char *buildPowTables(float *weights, int cPoints)
+{
+    unsigned char *tables = (unsigned char *)malloc(POW_LEVELS * 256);
+    unsigned char *built = (unsigned char *)calloc(POW_LEVELS, 1);
+    double logs[256];
+    double weight = 0.0;
+    int level = 0;
+    int u = 0;
+    int i = 0;
+
+    if (NULL == tables || NULL == built)
+    {
+        free(tables);
+        free(built);
+        return NULL;
+    }
+
+    for (u = 0; u < 256; u++)
+    {
+        logs[u] = log(u / 255.0);
+    }
+
+    for (i = 0; i < cPoints; i=i+2)
+    {
+        // 1 and the weights that are skipped never look a table up
+        if (!(weights[i/2] > 0.f) || 1.f == weights[i/2]) continue;
+        level = powLevel(weights[i/2]);
+        if (built[level]) continue;
+
+        // the table of the level, not of the first weight that maps to it,
+        // so the output doesn't depend on the order of the points
+        weight = pow(2.0, (double)(level - POW_OCTAVES * POW_STEPS) / POW_STEPS);
+        for (u = 0; u < 256; u++)
+        {
+            tables[level*256 + u] = (unsigned char)(255.0 * exp(weight * logs[u]) + 0.5);
+        }
+        built[level] = 1;
+    }
+
+    free(built);
+    return tables;
+}
+
+void stampBand(struct band *b)
+{
+    struct info *inf = b->inf;
+    struct stamp *st = b->st;
+    int width = inf->width;
+    int height = inf->height;
+    int dotsize = inf->dotsize;
+
+    unsigned char *vals = NULL;
+    unsigned char *row = NULL;
+    unsigned char *px = NULL;
+    float *acc = NULL;
+    int *spans = NULL;
+    float weight = 1.f;
+    float accScale = 1.f / 205.f;
+    unsigned char *powTable = NULL;
+    int x0 = 0;
+    int y0 = 0;
+    int sub = 0;
+    int subX = 0;
+    int subY = 0;
+    int first = 0;
+    int last = 0;
+    int vStart = 0;
+    int vEnd = 0;
+    int u = 0;
+    int v = 0;
     int i = 0;
-    int ndx = 0;
     struct point pt = {0};  
+    // the top band counts the clipped points, so it rejects against the
+    // whole image rather than its own rows
+    struct box reach = reachBox(inf, b->rowStart,
+                                b->rowStart ? b->rowEnd : height,
+                                dotsize + 1.f, b->translated);
 
-    // initialize image data to white
-    for(i = 0; i < (int)width*height; i++) 
+    for(i = 0; i < b->cPoints; i=i+2)
+    {
+        if (NULL != b->weights)
+        {
+            weight = b->weights[i/2];
+            if (!(weight > 0.f)) continue;
+        }
+
+        pt.x = b->points[i];
+        pt.y = b->points[i+1];
+        // every band sees every point; only the first one counts the
+        // clipped ones
+        if (!IN_BOX(reach, pt.x, pt.y))
+        {
+            if (0 == b->rowStart && !b->translated) b->clipped++;
+            continue;
+        }
+        if (!b->translated)
+        {
+            pt = translate(inf, pt);
+            if (0 == b->rowStart &&
+                !(pt.x >= 0 && pt.x <= width && pt.y >= 0 && pt.y <= height))
+                b->clipped++;
+        }
+
+        // also keeps the int conversions below from overflowing
+        if (!(pt.x > -dotsize && pt.x < width + dotsize &&
+              pt.y > -dotsize && pt.y < height + dotsize)) continue;
+
+        x0 = (int)floorf(pt.x);
+        y0 = (int)floorf(pt.y);
+        // pt - floor(pt) rounds up to 1.0 for a point a hair below an
+        // integer, which would index one stamp past the end
+        subX = (int)((pt.x - x0) * st->subpix);
+        subY = (int)((pt.y - y0) * st->subpix);
+        if (subX >= st->subpix) subX = st->subpix - 1;
+        if (subY >= st->subpix) subY = st->subpix - 1;
+        sub = subY * st->subpix + subX;
+        x0 -= st->half;
+        y0 -= st->half;
+        // no column of the dot on the image
+        if (x0 + dotsize <= 0 || x0 >= width) continue;
+
+        // only the rows of the dot that fall inside this band
+        vStart = b->rowStart - y0;
+        vEnd = b->rowEnd - y0;
+        if (vStart < 0) vStart = 0;
+        if (vEnd > dotsize) vEnd = dotsize;
+        if (vStart >= vEnd) continue;
+
+        growDirty(b->dirty, x0 > 0 ? x0 : 0, y0 + vStart,
+                  x0 + dotsize < width ? x0 + dotsize : width, y0 + vEnd);
+
+        vals = st->vals + sub*dotsize*dotsize;
+        spans = st->spans + sub*dotsize*2;
+
+        // a point of weight w darkens like w points stacked on each
+        // other: pixVal/255 to the power of w.
+        if (NULL == b->acc && 1.f != weight)
+            powTable = b->powTables + powLevel(weight) * 256;
+        accScale = weight / 205.f;
+
+        for (v = vStart; v < vEnd; v++)
+        {
+            first = spans[v*2];
+            last = spans[v*2+1];
+            if (x0 + first < 0) first = -x0;
+            if (x0 + last > width) last = width - x0;
+
+            row = vals + v*dotsize;
+
+            #ifdef DEBUG
+            printf("pt.x: %.2f pt.y: %.2f row: %d cols: %d..%d\n", pt.x, pt.y, y0 + v, x0 + first, x0 + last);
+            #endif 
+
+            if (NULL != b->acc)
+            {
+                // pixVal runs from 50 at the center to 255 at the edge,
+                // which is a weight of 1 down to 0
+                acc = b->acc + (y0 + v)*width + x0;
+                for (u = first; u < last; u++)
+                {
+                    acc[u] += (255 - row[u]) * accScale;
+                } // for u
+                continue;
+            }
+
+            px = b->pixels + (y0 + v)*width + x0;
+            if (1.f == weight)
+            {
+                for (u = first; u < last; u++)
+                {
+                    px[u] = (px[u] * row[u]) / 255;
+                } // for u
+            }
+            else
+            {
+                for (u = first; u < last; u++)
+                {
+                    px[u] = (px[u] * powTable[row[u]]) / 255;
+                } // for u
+            }
+        } // for v
+    } // for i
+}
+
+#ifdef WIN32
+typedef HANDLE thread_t;
+
+DWORD WINAPI bandThread(LPVOID arg)
+{
+    stampBand((struct band *)arg);
+    return 0;
+}
+
+int startThread(thread_t *t, struct band *b)
+{
+    *t = CreateThread(NULL, 0, bandThread, b, 0, NULL);
+    return NULL != *t;
+}
+
+void joinThread(thread_t t)
+{
+    WaitForSingleObject(t, INFINITE);
+    CloseHandle(t);
+}
+#else
+typedef pthread_t thread_t;
+
+void *bandThread(void *arg)
+{
+    stampBand((struct band *)arg);
+    return NULL;
+}
+
+int startThread(thread_t *t, struct band *b)
+{
+    return 0 == pthread_create(t, NULL, bandThread, b);
+}
+
+void joinThread(thread_t t)
+{
+    pthread_join(t, NULL);
+}
+#endif
+
+//stamp the points into pixels or acc, whichever is not NULL, with one
+//band of rows per thread
+int runBands(struct info *inf, float *points, float *weights, int cPoints,
+             unsigned char *pixels, float *acc, int translated)
+{
+    struct stamp st = {0};
+    struct band *bands = NULL;
+    thread_t *handles = NULL;
+    int *started = NULL;
+    unsigned char *powTables = NULL;
+    int height = 0;
+    int threads = 0;
+    int i = 0;
+
+    if (NULL == inf || NULL == points || (NULL == pixels && NULL == acc) ||
+        inf->width <= 0 || inf->height <= 0 || inf->dotsize <= 0 || cPoints < 0)
+        return 0;
+
+    height = inf->height;
+    threads = inf->threads;
+
+    if (threads < 1) threads = 1;
+    if (threads > height) threads = height;
+
+    bands = (struct band *)calloc(threads, sizeof(struct band));
+    handles = (thread_t *)calloc(threads, sizeof(thread_t));
+    started = (int *)calloc(threads, sizeof(int));
+
+    if (NULL != weights && NULL == acc)
+        powTables = buildPowTables(weights, cPoints);
+
+    if (NULL == bands || NULL == handles || NULL == started ||
+        (NULL != weights && NULL == acc && NULL == powTables) ||
+        !buildStamp(&st, inf->dotsize))
+    {
+        free(bands);
+        free(handles);
+        free(started);
+        free(powTables);
+        return 0;
+    }
+
+    for (i = 0; i < threads; i++)
+    {
+        bands[i].inf = inf;
+        bands[i].st = &st;
+        bands[i].points = points;
+        bands[i].weights = weights;
+        bands[i].cPoints = cPoints;
+        bands[i].pixels = pixels;
+        bands[i].acc = acc;
+        bands[i].powTables = powTables;
+        bands[i].translated = translated;
+        bands[i].rowStart = (int)((long long)height * i / threads);
+        bands[i].rowEnd = (int)((long long)height * (i+1) / threads);
+    }
+
+    // the calling thread takes the first band.  if a thread can't be
+    // started its band is stamped here as well.
+    for (i = 1; i < threads; i++)
+    {
+        started[i] = startThread(&handles[i], &bands[i]);
+    }
+
+    stampBand(&bands[0]);
+
+    for (i = 1; i < threads; i++)
     {
-        pixels[i] = 0xff;
+        if (started[i])
+            joinThread(handles[i]);
+        else
+            stampBand(&bands[i]);
     }
 
-    for(i = 0; i < cPoints; i=i+2)
+    inf->result.clipped += bands[0].clipped;
+    for (i = 0; i < threads; i++)
     {
+        growDirty(inf->dirty, bands[i].dirty[0], bands[i].dirty[1],
+                  bands[i].dirty[2], bands[i].dirty[3]);
+    }
+
+    freeStamp(&st);
+    free(bands);
+    free(handles);
+    free(started);
+    free(powTables);
+    return 1;
+}
+
+//binned engine: sum the weights of the points that land on each pixel,
+//then stamp every non-empty pixel once with the summed weight.  the grid
+//reaches past the image edges by the dot radius, so dots centered just
+//off the image still show.  with many more points than pixels this does
+//one stamp per pixel instead of one per point; the points lose their
+//sub-pixel position in exchange.
+int stampBinned(struct info *inf, float *points, float *weights, int cPoints,
+                unsigned char *pixels, float *acc)
+{
+    int margin = inf->dotsize / 2 + 1;
+    int gw = inf->width + 2*margin;
+    int gh = inf->height + 2*margin;
+    float *grid = NULL;
+    float *cells = NULL;
+    float *cellWeights = NULL;
+    int cCells = 0;
+    float weight = 1.f;
+    struct point pt = {0};
+    struct box reach = reachBox(inf, 0, inf->height, margin + 1.f, 0);
+    int gx = 0;
+    int gy = 0;
+    int ret = 0;
+    int i = 0;
+
+    grid = (float *)calloc((size_t)gw * gh, sizeof(float));
+    if (NULL == grid) return 0;
+
+    for (i = 0; i < cPoints; i=i+2)
+    {
+        if (NULL != weights)
+        {
+            weight = weights[i/2];
+            if (!(weight > 0.f)) continue;
+        }
+
         pt.x = points[i];
         pt.y = points[i+1];
+        if (!IN_BOX(reach, pt.x, pt.y))
+        {
+            inf->result.clipped++;
+            continue;
+        }
         pt = translate(inf, pt);
+        if (!(pt.x >= 0 && pt.x <= inf->width && pt.y >= 0 && pt.y <= inf->height))
+            inf->result.clipped++;
+        if (!(pt.x >= -margin && pt.x < inf->width + margin &&
+              pt.y >= -margin && pt.y < inf->height + margin)) continue;
 
-        for (j = (int)pt.x - midpt; j < (int)pt.x + midpt; j++)
-        {   
-            for (k = (int)(pt.y - midpt); k < (int)(pt.y + midpt); k++)
-            {
-                if (j < 0 || k < 0 || j >= width || k >= height) continue; 
+        gx = (int)floorf(pt.x) + margin;
+        gy = (int)floorf(pt.y) + margin;
+        if (0 == grid[gy*gw + gx]) cCells++;
+        grid[gy*gw + gx] += weight;
+    }
 
-                dist = sqrt( (j-pt.x)*(j-pt.x) + (k-pt.y)*(k-pt.y) );
+    cells = (float *)malloc((cCells > 0 ? cCells : 1) * 2 * sizeof(float));
+    cellWeights = (float *)malloc((cCells > 0 ? cCells : 1) * sizeof(float));
+    if (NULL == cells || NULL == cellWeights)
+    {
+        free(grid);
+        free(cells);
+        free(cellWeights);
+        return 0;
+    }
 
-                pixVal = (int)(200.0*(dist/radius)+50.0);
-                if (pixVal > 255) pixVal = 255;
+    // cells become weighted points at pixel centers, in image coordinates
+    cCells = 0;
+    for (gy = 0; gy < gh; gy++)
+    {
+        for (gx = 0; gx < gw; gx++)
+        {
+            if (0 == grid[gy*gw + gx]) continue;
+            cells[cCells*2] = gx - margin + 0.5f;
+            cells[cCells*2+1] = gy - margin + 0.5f;
+            cellWeights[cCells] = grid[gy*gw + gx];
+            cCells++;
+        }
+    }
+    free(grid);
 
-                ndx = k*width + j;
-                if(ndx >= (int)width*height) continue;   // ndx can be greater than array bounds
+    ret = runBands(inf, cells, cellWeights, cCells*2, pixels, acc, 1);
 
-                #ifdef DEBUG
-                printf("pt.x: %.2f pt.y: %.2f j: %d k: %d ndx: %d\n", pt.x, pt.y, j, k, ndx);
-                #endif 
+    free(cells);
+    free(cellWeights);
+    return ret;
+}
 
-                pixels[ndx] = (pixels[ndx] * pixVal) / 255;
-            } // for k
-        } //for j
-    } // for i
+// box blur passes approximating a gaussian, and the gaussian's sigma as a
+// fraction of dotsize.  at 0.15 the blurred dot fades out about where a
+// stamped dot ends.
+#define BLUR_PASSES 3
+#define BLUR_SIGMA 0.15f
+// log of the multiplier at the center of a stamped dot, pixVal 50 / 255
+#define LOG_CENTER -1.6292405f
 
-    return pixels;
+//box blur of radius r along n values spaced step apart, treating
+//everything beyond the ends as 0.  tmp holds n floats.
+void boxBlurLine(float *line, int n, int step, int r, float *tmp)
+{
+    float scale = 1.f / (2*r + 1);
+    float sum = 0.f;
+    int i = 0;
+
+    for (i = 0; i < n; i++)
+    {
+        tmp[i] = line[i*step];
+    }
+    for (i = 0; i < r && i < n; i++)
+    {
+        sum += tmp[i];
+    }
+    for (i = 0; i < n; i++)
+    {
+        if (i + r < n) sum += tmp[i + r];
+        line[i*step] = sum * scale;
+        if (i - r >= 0) sum -= tmp[i - r];
+    }
 }
 
-unsigned char *colorize(struct info *inf, unsigned char* pixels_bw, int *scheme, unsigned char* pixels_color, 
-              int opacity)
+//blur engine: sum the points into a grid like the binned engine, then
+//blur the grid with BLUR_PASSES separable box blurs.  the cost is
+//O(width * height * passes) whatever the dotsize or point count.
+//additive mode adds the blurred grid, scaled so a lone point peaks at 1
+//like a stamped one.  multiply mode treats it as a sum of log multipliers,
+//so overlapping dots still compound.
+int stampBlurred(struct info *inf, float *points, float *weights, int cPoints,
+                 unsigned char *pixels, float *acc)
 {
     int width = inf->width;
     int height = inf->height;
-    int dotsize = inf->dotsize;
-    
+    float sigma = inf->dotsize * BLUR_SIGMA;
+    int r = (int)((sqrtf(12.f * sigma*sigma / BLUR_PASSES + 1.f) - 1.f) / 2.f + 0.5f);
+    int margin = BLUR_PASSES * r + 1;
+    int gw = width + 2*margin;
+    int gh = height + 2*margin;
+    float *grid = NULL;
+    float *tmp = NULL;
+    float *line = NULL;
+    float weight = 1.f;
+    float peak = 0.f;
+    float b = 0.f;
+    struct point pt = {0};
+    struct box reach = reachBox(inf, 0, height, margin + 1.f, 0);
+    int pass = 0;
+    int first = 0;
+    int last = 0;
+    int x = 0;
+    int y = 0;
+    int i = 0;
+
+    grid = (float *)calloc((size_t)gw * gh, sizeof(float));
+    tmp = (float *)malloc((gw > gh ? gw : gh) * sizeof(float));
+    line = (float *)calloc(2*margin + 1, sizeof(float));
+    if (NULL == grid || NULL == tmp || NULL == line)
+    {
+        free(grid);
+        free(tmp);
+        free(line);
+        return 0;
+    }
+
+    for (i = 0; i < cPoints; i=i+2)
+    {
+        if (NULL != weights)
+        {
+            weight = weights[i/2];
+            if (!(weight > 0.f)) continue;
+        }
+
+        pt.x = points[i];
+        pt.y = points[i+1];
+        if (!IN_BOX(reach, pt.x, pt.y))
+        {
+            inf->result.clipped++;
+            continue;
+        }
+        pt = translate(inf, pt);
+        if (!(pt.x >= 0 && pt.x <= width && pt.y >= 0 && pt.y <= height))
+            inf->result.clipped++;
+        if (!(pt.x >= -margin && pt.x < width + margin &&
+              pt.y >= -margin && pt.y < height + margin)) continue;
+
+        grid[((int)floorf(pt.y) + margin)*gw + (int)floorf(pt.x) + margin] += weight;
+    }
+
+    for (pass = 0; pass < BLUR_PASSES; pass++)
+    {
+        for (y = 0; y < gh; y++)
+            boxBlurLine(grid + y*gw, gw, 1, r, tmp);
+        for (x = 0; x < gw; x++)
+            boxBlurLine(grid + x, gh, gw, r, tmp);
+    }
+
+    // the peak a single point blurs down to, to scale it back up to 1
+    line[margin] = 1.f;
+    for (pass = 0; pass < BLUR_PASSES; pass++)
+        boxBlurLine(line, 2*margin + 1, 1, r, tmp);
+    peak = line[margin] * line[margin];
+    free(line);
+    free(tmp);
+
+    for (y = 0; y < height; y++)
+    {
+        first = width;
+        last = 0;
+        for (x = 0; x < width; x++)
+        {
+            b = grid[(y + margin)*gw + x + margin] / peak;
+            // running sums leave rounding noise where nothing was stamped
+            if (b < 1e-6f) continue;
+
+            if (x < first) first = x;
+            last = x + 1;
+            i = y*width + x;
+            if (NULL != acc)
+                acc[i] += b;
+            else
+                pixels[i] = (unsigned char)(pixels[i] * expf(b * LOG_CENTER));
+        }
+        growDirty(inf->dirty, first, y, last, y + 1);
+    }
+
+    free(grid);
+    return 1;
+}
+
+//project the bounds once, rather than for every point in translate
+void projectBounds(struct info *inf)
+{
+    if (PROJ_WEB_MERCATOR == inf->projection)
+    {
+        inf->minY = (float)mercY(inf->minY);
+        inf->maxY = (float)mercY(inf->maxY);
+    }
+}
+
+int stampPoints(struct info *inf, float *points, float *weights, int cPoints,
+                unsigned char *pixels, float *acc)
+{
+    struct info proj;
+    int ret = 0;
+
+    if (NULL == inf) return 0;
+    if (NULL == points || (NULL == pixels && NULL == acc) ||
+        inf->width <= 0 || inf->height <= 0 || inf->dotsize <= 0 || cPoints < 0 ||
+        inf->projection < PROJ_LINEAR || inf->projection > PROJ_WEB_MERCATOR)
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    proj = *inf;
+    projectBounds(&proj);
+
+    if (ENGINE_BINNED == proj.engine)
+        ret = stampBinned(&proj, points, weights, cPoints, pixels, acc);
+    else if (ENGINE_BLUR == proj.engine)
+        ret = stampBlurred(&proj, points, weights, cPoints, pixels, acc);
+    else
+        ret = runBands(&proj, points, weights, cPoints, pixels, acc, 0);
+
+    // the engines only fail to allocate
+    memcpy(inf->dirty, proj.dirty, sizeof(inf->dirty));
+    inf->result.clipped = proj.result.clipped;
+    inf->result.status = ret ? STATUS_OK : STATUS_NO_MEMORY;
+    return ret;
+}
+
+//stamp the points into an existing density buffer.  pixels starts out
+//as all 0xff and darkens as points are added, so a buffer can be built up
+//over any number of calls.  weights is NULL or holds one per point.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int addDensity(struct info *inf, float *points, float *weights, int cPoints,
+               unsigned char *pixels)
+{
+    if (NULL == pixels) return 0;
+    return stampPoints(inf, points, weights, cPoints, pixels, NULL);
+}
+
+//additive mode: sum the kernel weight of every point into acc, a float
+//per pixel starting at 0.  unlike addDensity this never saturates;
+//normalizeWeights maps the sums onto the 256 density levels afterwards.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int addWeights(struct info *inf, float *points, float *weights, int cPoints,
+               float *acc)
+{
+    if (NULL == acc) return 0;
+    return stampPoints(inf, points, weights, cPoints, NULL, acc);
+}
+
+//sum the weights of the points (1 each without weights) landing in each
+//cell of a cw x ch grid laid over the image into cells.  a pre-pass to
+//size the dots from before stamping anything; points off the image are
+//left out.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int countCells(struct info *inf, float *points, float *weights, int cPoints,
+               float *cells, int cw, int ch)
+{
+    struct info proj;
+    struct point pt = {0};
+    float weight = 1.f;
+    float sx = 0.f;
+    float sy = 0.f;
+    int cx = 0;
+    int cy = 0;
+    int i = 0;
+
+    if (NULL == inf) return 0;
+    if (NULL == points || NULL == cells || cw <= 0 || ch <= 0 ||
+        inf->width <= 0 || inf->height <= 0 || cPoints < 0 ||
+        inf->projection < PROJ_LINEAR || inf->projection > PROJ_WEB_MERCATOR)
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    proj = *inf;
+    projectBounds(&proj);
+    sx = (float)cw / inf->width;
+    sy = (float)ch / inf->height;
+
+    for (i = 0; i < cPoints; i=i+2)
+    {
+        if (NULL != weights)
+        {
+            weight = weights[i/2];
+            if (!(weight > 0.f)) continue;
+        }
+
+        pt.x = points[i];
+        pt.y = points[i+1];
+        pt = translate(&proj, pt);
+        if (!(pt.x >= 0 && pt.x < inf->width && pt.y >= 0 && pt.y < inf->height))
+            continue;
+
+        cx = (int)(pt.x * sx);
+        cy = (int)(pt.y * sy);
+        if (cx >= cw) cx = cw - 1;
+        if (cy >= ch) cy = ch - 1;
+        cells[cy*cw + cx] += weight;
+    }
+
+    inf->result.status = STATUS_OK;
+    return 1;
+}
+
+#define CURVE_LINEAR 0
+#define CURVE_LOG 1
+#define CURVE_SQRT 2
+#define CLIP_BINS 4096
+
+float applyCurve(float v, int curve)
+{
+    if (CURVE_LOG == curve) return logf(1.f + v);
+    if (CURVE_SQRT == curve) return sqrtf(v);
+    return v;
+}
+
+//map the summed weights in acc onto density levels in pixels: 0xff where
+//nothing was stamped, 0 at the ceiling.  the ceiling is the largest sum,
+//or with clip < 100 that percentile of the stamped pixels, found with a
+//histogram so it stays a linear pass.  only the dirty rectangle is
+//walked; everything outside it was never stamped and stays 0xff.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int normalizeWeights(struct info *inf, float *acc, unsigned char *pixels,
+                     int curve, float clip)
+{
+    int stamped = 0;
+    int bin = 0;
+    int seen = 0;
+    int *hist = NULL;
+    float maxV = 0.f;
+    float ceiling = 0.f;
+    float scale = 0.f;
+    float v = 0.f;
+    int x0 = 0;
+    int x1 = 0;
+    int x = 0;
+    int y = 0;
     int i = 0;
-    int pix = 0;
-    int highCount = 0;
-    int alpha = opacity;
 
-    for(i = 0; i < (int)width*height; i++)
+    if (NULL == inf) return 0;
+    if (NULL == acc || NULL == pixels ||
+        inf->width <= 0 || inf->height <= 0 || clip <= 0.f || clip > 100.f)
     {
-        pix = pixels_bw[i];
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+    inf->result.status = STATUS_OK;
+
+    x0 = inf->dirty[0];
+    x1 = inf->dirty[2];
+    if (x1 <= x0) return 1;
+
+    for (y = inf->dirty[1]; y < inf->dirty[3]; y++)
+    {
+        for (x = x0, i = y*inf->width + x0; x < x1; x++, i++)
+        {
+            if (acc[i] > maxV) maxV = acc[i];
+            if (acc[i] > 0.f) stamped++;
+        }
+    }
+
+    ceiling = maxV;
+    if (clip < 100.f && maxV > 0.f)
+    {
+        hist = (int *)calloc(CLIP_BINS, sizeof(int));
+        if (NULL == hist)
+        {
+            inf->result.status = STATUS_NO_MEMORY;
+            return 0;
+        }
+
+        for (y = inf->dirty[1]; y < inf->dirty[3]; y++)
+        {
+            for (x = x0, i = y*inf->width + x0; x < x1; x++, i++)
+            {
+                if (acc[i] <= 0.f) continue;
+                bin = (int)(acc[i] / maxV * (CLIP_BINS - 1));
+                hist[bin]++;
+            }
+        }
+        for (bin = 0; bin < CLIP_BINS; bin++)
+        {
+            seen += hist[bin];
+            if (seen >= stamped * (clip / 100.f)) break;
+        }
+        ceiling = maxV * (bin + 1) / (CLIP_BINS - 1);
+        if (ceiling > maxV) ceiling = maxV;
+        free(hist);
+    }
+
+    if (ceiling > 0.f) scale = 255.f / applyCurve(ceiling, curve);
+
+    for (y = inf->dirty[1]; y < inf->dirty[3]; y++)
+    {
+        for (x = x0, i = y*inf->width + x0; x < x1; x++, i++)
+        {
+            v = acc[i];
+            if (v <= 0.f)
+            {
+                pixels[i] = 0xff;
+                continue;
+            }
+            if (v > ceiling) v = ceiling;
+            pixels[i] = (unsigned char)(255 - (int)(applyCurve(v, curve) * scale + 0.5f));
+        }
+    }
 
-        if (pix < 0x10) highCount++;
-        if (pix <= 252) 
-            alpha = opacity; 
-        else 
-            alpha = 0;
+    return 1;
+}
 
-        pixels_color[i*4] = scheme[pix*3];
-        pixels_color[i*4+1] = scheme[pix*3+1];
-        pixels_color[i*4+2] = scheme[pix*3+2];
-        pixels_color[i*4+3] = alpha;
-    } 
+unsigned char* calcDensity(struct info *inf, float *points, int cPoints)
+{
+    int width = inf->width;
+    int height = inf->height;
     
-    if (highCount > width*height*0.8)
-    {   
-        fprintf(stderr, "Warning: 80%% of output pixels are over 95%% density.\n");
-        fprintf(stderr, "Decrease dotsize or increase output image resolution?\n");
+    unsigned char* pixels = (unsigned char *)calloc(width*height, sizeof(char)); 
+
+    if (NULL == pixels)
+    {
+        inf->result.status = STATUS_NO_MEMORY;
+        return NULL;
     }
 
+    // initialize image data to white
+    memset(pixels, 0xff, width*height);
+
+    if (!addDensity(inf, points, NULL, cPoints, pixels))
+    {
+        free(pixels);
+        return NULL;
+    }
+
+    return pixels;
+}
+
+//colorize columns x0..x1-1 of rows y0..y1-1 through lut, a packed table
+//of r, g, b, a for each of the 256 levels with the alpha already applied,
+//as built by colorschemes.rgba().  out holds the pixel at (x0, y0) and its
+//rows are stride pixels apart.  one 4 byte copy per pixel.  out may be
+//NULL to only count the levels.  leaves the histogram of the levels and
+//whether the image is saturated in inf->result.
+void colorizeRect(struct info *inf, unsigned char *pixels_bw,
+                  const unsigned char *lut, unsigned char *out,
+                  int x0, int y0, int x1, int y1, int stride)
+{
+    int *hist = inf->result.histogram;
+    unsigned char *src = NULL;
+    unsigned char *dst = NULL;
+    int highCount = 0;
+    int level = 0;
+    int x = 0;
+    int y = 0;
+
+    memset(hist, 0, sizeof(inf->result.histogram));
+    for (y = y0; y < y1; y++)
+    {
+        src = pixels_bw + y*inf->width;
+        if (NULL == out)
+        {
+            for (x = x0; x < x1; x++)
+                hist[src[x]]++;
+            continue;
+        }
+        dst = out + (size_t)(y - y0)*stride*4;
+        for (x = x0; x < x1; x++)
+        {
+            hist[src[x]]++;
+            memcpy(dst + (x - x0)*4, lut + src[x]*4, 4);
+        }
+    }
+
+    // pixels outside the rectangle are empty, so these are the counts for
+    // the whole image
+    hist[0xff] += inf->width*inf->height - (x1 - x0)*(y1 - y0);
+    for (level = 0; level < 0x10; level++)
+        highCount += hist[level];
+
+    inf->result.status = STATUS_OK;
+    if (highCount > inf->width*inf->height*0.8)
+        inf->result.status = STATUS_SATURATED;
+}
+
+//colorizeRect over the dirty rectangle, or just the counts if there is
+//nothing stamped
+void colorizeDirty(struct info *inf, unsigned char *pixels_bw,
+                   const unsigned char *lut, unsigned char *out, int stride)
+{
+    int *d = inf->dirty;
+
+    if (d[2] > d[0])
+        colorizeRect(inf, pixels_bw, lut, out, d[0], d[1], d[2], d[3], stride);
+    else
+        colorizeRect(inf, pixels_bw, lut, NULL, 0, 0, 0, 0, stride);
+}
+
+//colorize the dirty rectangle of the density into the full size RGBA
+//buffer pixels_color, and fill the pixels outside it with the color of
+//the empty level, which is all they could be colorized to.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int colorizeLUT(struct info *inf, unsigned char *pixels_bw,
+                const unsigned char *lut, unsigned char *pixels_color)
+{
+    const unsigned char *empty = NULL;
+    unsigned char *row = NULL;
+    int x0 = 0;
+    int x1 = 0;
+    int y0 = 0;
+    int y1 = 0;
+    int x = 0;
+    int y = 0;
+
+    if (NULL == inf) return 0;
+    if (NULL == pixels_bw || NULL == lut || NULL == pixels_color)
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    if (inf->dirty[2] > inf->dirty[0])
+    {
+        x0 = inf->dirty[0];
+        y0 = inf->dirty[1];
+        x1 = inf->dirty[2];
+        y1 = inf->dirty[3];
+    }
+    colorizeDirty(inf, pixels_bw, lut,
+                  pixels_color + ((size_t)y0*inf->width + x0)*4,
+                  inf->width);
+
+    empty = lut + 0xff*4;
+    for (y = 0; y < inf->height; y++)
+    {
+        row = pixels_color + (size_t)y*inf->width*4;
+        for (x = 0; x < inf->width; x++)
+        {
+            // skip over the row of the rectangle
+            if (x == x0 && y >= y0 && y < y1 && x1 > x0)
+            {
+                x = x1 - 1;
+                continue;
+            }
+            memcpy(row + x*4, empty, 4);
+        }
+    }
+    return 1;
+}
+
+//colorize only the dirty rectangle of the density into pixels_color,
+//an RGBA image the size of the rectangle
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int colorizeCrop(struct info *inf, unsigned char *pixels_bw,
+                 const unsigned char *lut, unsigned char *pixels_color)
+{
+    if (NULL == inf) return 0;
+    if (NULL == pixels_bw || NULL == lut || NULL == pixels_color)
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    colorizeDirty(inf, pixels_bw, lut, pixels_color,
+                  inf->dirty[2] - inf->dirty[0]);
+    return 1;
+}
+
+//histogram of the density levels into inf->result, and whether they are
+//saturated, as colorizing them would find.  for renders that don't
+//colorize, like palette images.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int countLevels(struct info *inf, unsigned char *pixels_bw)
+{
+    if (NULL == inf) return 0;
+    if (NULL == pixels_bw)
+    {
+        inf->result.status = STATUS_INVALID;
+        return 0;
+    }
+
+    colorizeDirty(inf, pixels_bw, NULL, NULL, 0);
+    return 1;
+}
+
+//colorize with a scheme of 256 r, g, b ints and an opacity; the levels
+//over 252 are transparent.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+unsigned char *colorize(struct info *inf, unsigned char* pixels_bw, int *scheme, unsigned char* pixels_color, 
+              int opacity)
+{
+    unsigned char lut[256*4];
+    int i = 0;
+
+    if (NULL == inf || NULL == pixels_bw || NULL == scheme || NULL == pixels_color)
+        return NULL;
+
+    for (i = 0; i < 256; i++)
+    {
+        lut[i*4] = scheme[i*3];
+        lut[i*4+1] = scheme[i*3+1];
+        lut[i*4+2] = scheme[i*3+2];
+        lut[i*4+3] = (i <= 252) ? opacity : 0;
+    }
+
+    // every pixel, for callers that don't zero the buffer
+    colorizeRect(inf, pixels_bw, lut, pixels_color, 0, 0, inf->width,
+                 inf->height, inf->width);
     return pixels_color;
 }
 
+//the whole render in one call, stamped on threads threads.  returns
+//pix_color, or NULL if the parameters are bad or memory ran out.  if res
+//isn't NULL it gets the result of the render, with the reason for a
+//failure in its status.
 #ifdef WIN32
 __declspec(dllexport)
 #endif
-unsigned char *tx(float *points, 
+unsigned char *txResult(float *points, 
                   int cPoints, 
                   int w, int h, 
                   int dotsize, 
@@ -190,23 +1558,30 @@ unsigned char *tx(float *points,
                   unsigned char *pix_color, 
                   int opacity, 
                   int boundsOverride, 
-                  float minX, float minY, float maxX, float maxY)
+                  float minX, float minY, float maxX, float maxY,
+                  int threads,
+                  struct result *res)
 {
     unsigned char *pixels_bw = NULL;
+    struct info inf = {0};
 
     //basic sanity checks to keep from segfaulting
     if (NULL == points || NULL == scheme || NULL == pix_color ||
-        w <= 0 || h <= 0 || cPoints <= 1 || opacity < 0 || dotsize <= 0)
+        w <= 0 || h <= 0 || cPoints <= 1 || opacity < 0 || dotsize <= 0 ||
+        threads <= 0)
     {
-        fprintf(stderr, "Invalid parameter; aborting.\n");
+        if (NULL != res)
+        {
+            memset(res, 0, sizeof(*res));
+            res->status = STATUS_INVALID;
+        }
         return NULL;
     }
     
-    struct info inf = {0};
-    
     inf.dotsize = dotsize;
     inf.width = w;
     inf.height = h;
+    inf.threads = threads;
  
     // get min/max x/y values from point list
     if (boundsOverride == 1)
@@ -226,13 +1601,215 @@ unsigned char *tx(float *points,
     //iterate through points, place a dot at each center point
     //and set pix value from 0 - 255 using multiply method for radius [dotsize].
     pixels_bw = calcDensity(&inf, points, cPoints);
+    if (NULL == pixels_bw)
+    {
+        if (NULL != res) *res = inf.result;
+        return NULL;
+    }
 
     //using provided color scheme and opacity, update pixel value to RGBA values
     pix_color = colorize(&inf, pixels_bw, scheme, pix_color, opacity);
 
     free(pixels_bw);
     pixels_bw = NULL;
+    if (NULL != res) *res = inf.result;
 
     //return list of RGBA values
     return pix_color;
 }
+
+//txResult on one thread and without the result: the original export,
+//whose arguments must not change
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+unsigned char *tx(float *points, 
+                  int cPoints, 
+                  int w, int h, 
+                  int dotsize, 
+                  int *scheme, 
+                  unsigned char *pix_color, 
+                  int opacity, 
+                  int boundsOverride, 
+                  float minX, float minY, float maxX, float maxY)
+{
+    return txResult(points, cPoints, w, h, dotsize, scheme, pix_color,
+                    opacity, boundsOverride, minX, minY, maxX, maxY, 1,
+                    NULL);
+}
+
+// spatial index for map tiles.  points are lon/lat; a point's key is the
+// morton code (x and y bits interleaved) of the web mercator XYZ tile it
+// falls in at the index zoom, so after sorting by key every tile at that
+// zoom or above holds a contiguous run of points.
+#define MAX_INDEX_ZOOM 24
+#define NO_TILE 0xffffffffffffffffULL
+
+unsigned long long spreadBits(unsigned long long v)
+{
+    v &= 0xffffffULL;
+    v = (v | (v << 16)) & 0x0000ff0000ffffULL;
+    v = (v | (v << 8)) & 0x00ff00ff00ff00ffULL;
+    v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0fULL;
+    v = (v | (v << 2)) & 0x3333333333333333ULL;
+    v = (v | (v << 1)) & 0x5555555555555555ULL;
+    return v;
+}
+
+unsigned long long tileKey(float lon, float lat, int zoom)
+{
+    double n = (double)(1 << zoom);
+    double x = 0.0;
+    double y = 0.0;
+
+    // also rejects NaN
+    if (!(lon >= -180.f && lon <= 180.f && lat >= -MAX_LAT && lat <= MAX_LAT))
+        return NO_TILE;
+
+    x = (lon + 180.0) / 360.0 * n;
+    y = (1.0 - mercY(lat) / PI) / 2.0 * n;
+    if (x >= n) x = n - 1;
+    if (y >= n) y = n - 1;
+    if (y < 0) y = 0;
+
+    return spreadBits((unsigned long long)x) | (spreadBits((unsigned long long)y) << 1);
+}
+
+//compute the tile key of every point at zoom and sort the points (and
+//their weights, if not NULL) by key in place, with a radix sort.  points
+//outside the mercator range get NO_TILE and end up last.
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+int sortTiles(float *points, float *weights, int cPoints, int zoom,
+              unsigned long long *keys)
+{
+    int n = cPoints / 2;
+    int passes = (2*zoom + 7) / 8 + 1;
+    unsigned long long *tmpKeys = NULL;
+    unsigned int *order = NULL;
+    unsigned int *tmpOrder = NULL;
+    unsigned int *swap = NULL;
+    unsigned long long *swapKeys = NULL;
+    float *tmp = NULL;
+    int counts[257];
+    int shift = 0;
+    int pass = 0;
+    int i = 0;
+
+    if (NULL == points || NULL == keys || cPoints < 0 || zoom < 0 ||
+        zoom > MAX_INDEX_ZOOM)
+        return 0;
+
+    tmpKeys = (unsigned long long *)malloc((n > 0 ? n : 1) * sizeof(unsigned long long));
+    order = (unsigned int *)malloc((n > 0 ? n : 1) * sizeof(unsigned int));
+    tmpOrder = (unsigned int *)malloc((n > 0 ? n : 1) * sizeof(unsigned int));
+    tmp = (float *)malloc((cPoints > 0 ? cPoints : 1) * sizeof(float));
+    if (NULL == tmpKeys || NULL == order || NULL == tmpOrder || NULL == tmp)
+    {
+        free(tmpKeys);
+        free(order);
+        free(tmpOrder);
+        free(tmp);
+        return 0;
+    }
+
+    for (i = 0; i < n; i++)
+    {
+        keys[i] = tileKey(points[i*2], points[i*2+1], zoom);
+        order[i] = i;
+    }
+
+    // least significant byte first; the last pass covers the top byte, so
+    // NO_TILE sorts after every real key.  keys are only 2*zoom bits.
+    for (pass = 0; pass < passes; pass++)
+    {
+        shift = (pass == passes - 1) ? 56 : pass * 8;
+
+        memset(counts, 0, sizeof(counts));
+        for (i = 0; i < n; i++)
+            counts[((keys[i] >> shift) & 0xff) + 1]++;
+        for (i = 0; i < 256; i++)
+            counts[i+1] += counts[i];
+        for (i = 0; i < n; i++)
+        {
+            int dst = counts[(keys[i] >> shift) & 0xff]++;
+            tmpKeys[dst] = keys[i];
+            tmpOrder[dst] = order[i];
+        }
+
+        swapKeys = keys; keys = tmpKeys; tmpKeys = swapKeys;
+        swap = order; order = tmpOrder; tmpOrder = swap;
+    }
+
+    // an odd number of passes leaves the sorted keys in the scratch buffer
+    if (passes % 2)
+    {
+        memcpy(tmpKeys, keys, n * sizeof(unsigned long long));
+        swapKeys = keys; keys = tmpKeys; tmpKeys = swapKeys;
+    }
+
+    for (i = 0; i < n; i++)
+    {
+        tmp[i*2] = points[order[i]*2];
+        tmp[i*2+1] = points[order[i]*2+1];
+    }
+    memcpy(points, tmp, n * 2 * sizeof(float));
+
+    if (NULL != weights)
+    {
+        for (i = 0; i < n; i++)
+            tmp[i] = weights[order[i]];
+        memcpy(weights, tmp, n * sizeof(float));
+    }
+
+    free(tmpKeys);
+    free(order);
+    free(tmpOrder);
+    free(tmp);
+    return 1;
+}
+
+// fingerprint of a buffer for caching renders.  a fast 64 bit hash, eight
+// bytes per step; not cryptographic.
+#define HASH_K1 0x87c37b91114253d5ULL
+#define HASH_K2 0x4cf5ad432745937fULL
+
+unsigned long long mix64(unsigned long long h)
+{
+    h ^= h >> 33;
+    h *= 0xff51afd7ed558ccdULL;
+    h ^= h >> 33;
+    h *= 0xc4ceb9fe1a85ec53ULL;
+    h ^= h >> 33;
+    return h;
+}
+
+#ifdef WIN32
+__declspec(dllexport)
+#endif
+unsigned long long fingerprint(const unsigned char *data, long long nbytes,
+                               unsigned long long seed)
+{
+    unsigned long long h = seed ^ ((unsigned long long)nbytes * HASH_K1);
+    unsigned long long v = 0;
+    long long i = 0;
+
+    if (NULL == data || nbytes < 0) return 0;
+
+    for (i = 0; i + 8 <= nbytes; i += 8)
+    {
+        memcpy(&v, data + i, 8);
+        v *= HASH_K1;
+        v = (v << 31) | (v >> 33);
+        v *= HASH_K2;
+        h ^= v;
+        h = ((h << 27) | (h >> 37)) * 5 + 0x52dce729;
+    }
+
+    v = 0;
+    memcpy(&v, data + i, (size_t)(nbytes - i));
+    h ^= v * HASH_K2;
+
+    return mix64(h);
+}
@@ -1,13 +1,54 @@
 import os
 import sys
+import time
 import ctypes
 import platform
 import math
+import threading
+import warnings
+import Queue
+import zlib
+import struct
+from cStringIO import StringIO
 
 import colorschemes
 
 from PIL import Image
 
+class SaturationWarning(UserWarning):
+    """
+    Most of a heatmap came out at full density, so it shows little more
+    than a blob: the dots are too big for the image, or too many overlap
+    for multiply mode.  Turn it into an exception with
+    warnings.simplefilter("error", SaturationWarning).
+    """
+
+
+class _Result(ctypes.Structure):
+    """ mirrors struct result in heatmap.c """
+    _fields_ = [('status', ctypes.c_int),
+                ('clipped', ctypes.c_int),
+                ('histogram', ctypes.c_int * 256)]
+
+    # status codes, and the messages of the failures
+    OK, INVALID, NO_MEMORY, SATURATED = range(4)
+    ERRORS = {INVALID: "Invalid parameters.", NO_MEMORY: "Out of memory."}
+
+class _Info(ctypes.Structure):
+    """ mirrors struct info in heatmap.c """
+    _fields_ = [('minX', ctypes.c_float),
+                ('minY', ctypes.c_float),
+                ('maxX', ctypes.c_float),
+                ('maxY', ctypes.c_float),
+                ('width', ctypes.c_int),
+                ('height', ctypes.c_int),
+                ('dotsize', ctypes.c_int),
+                ('threads', ctypes.c_int),
+                ('engine', ctypes.c_int),
+                ('projection', ctypes.c_int),
+                ('dirty', ctypes.c_int * 4),
+                ('result', _Result)]
+
 class Heatmap:
     """
     Create heatmaps from a list of 2D coordinates.
@@ -24,6 +65,18 @@ class Heatmap:
     your wireless network.
 
     Most of the magic starts in heatmap(), see below for description of that function.
+
+    The C library is loaded with ctypes.cdll, so the GIL is released for the
+    whole native render.  A Heatmap instance can be shared between threads:
+    heatmap() keeps its working state local and only publishes the finished
+    render (img, points, area, ...) for saveKML().  render_many() renders a
+    batch of heatmaps on a thread pool.
+
+    libpath -> path to the heatmap shared library to load instead of the
+               one found in sys.path
+    hook    -> function called with a RenderStats after every heatmap(),
+               e.g. to forward the timings to a metrics system.  It runs
+               on the rendering thread.
     """
 
     KML = """<?xml version="1.0" encoding="UTF-8"?>
@@ -44,10 +97,18 @@ class Heatmap:
   </Folder>
 </kml>"""
 
-    def __init__(self, libpath=None):
+    # numpy typestr for a native float32, which is what tx() expects
+    _FLOAT32 = (sys.byteorder == 'little' and '<' or '>') + 'f4'
+
+    def __init__(self, libpath=None, hook=None):
+        self.hook = hook
         self.minXY = ()
         self.maxXY = ()
         self.img = None
+        self.points = None
+        self.area = None
+        self.override = 0
+        self._lock = threading.Lock()
         # if you're reading this, it's probably because this
         # hacktastic garbage failed.  sorry.  I deserve a jab or two via @jjguy.
 
@@ -75,99 +136,549 @@ class Heatmap:
         if not self._heatmap:
             raise Exception("Heatmap shared library not found in PYTHONPATH.")
 
-    def heatmap(self, points, dotsize=150, opacity=128, size=(1024, 1024), scheme="classic", area=None):
+    def heatmap(self, points, dotsize=150, opacity=128, size=(1024, 1024), scheme="classic", area=None,
+                threads=1, mode="multiply", normalize="linear", clip=100, weights=None,
+                engine="stamp", projection="linear", palette=False, stats=None,
+                finite=False, autoclip=None):
         """
         points  -> an iterable list of tuples, where the contents are the
                    x,y coordinates to plot. e.g., [(1, 1), (2, 2), (3, 3)]
+                   Also accepts any object exposing the buffer protocol
+                   that holds float32 x,y pairs, such as a contiguous
+                   numpy float32 Nx2 array or an array.array('f'); its
+                   memory is handed to the C code without conversion.
+                   Tuples can also be x,y,weight triples, see weights.
         dotsize -> the size of a single coordinate in the output image in
                    pixels, default is 150px.  Tweak this parameter to adjust
-                   the resulting heatmap.
+                   the resulting heatmap, or pass "auto" to have tune()
+                   pick it from the points.
         opacity -> the strength of a single coordiniate in the output image.
-                   Tweak this parameter to adjust the resulting heatmap.
+                   Tweak this parameter to adjust the resulting heatmap, or
+                   pass "auto", see tune().
         size    -> tuple with the width, height in pixels of the output PNG
         scheme  -> Name of color scheme to use to color the output image.
                    Use schemes() to get list.  (images are in source distro)
+                   colorschemes.register() adds custom schemes.
         area    -> Specify bounding coordinates of the output image. Tuple of
                    tuples: ((minX, minY), (maxX, maxY)).  If None or unspecified,
-                   these values are calculated based on the input data.
+                   these values are calculated based on the input data,
+                   by the C code, ignoring points with a NaN or infinite
+                   coordinate.
+        threads -> number of threads used to stamp the points.  The image
+                   is split into horizontal bands, one per thread; the
+                   output is identical to a single-threaded render.
+        mode    -> how overlapping dots combine.  "multiply" (the default)
+                   darkens each pixel by every dot on it, which saturates
+                   after a few dozen overlapping points.  "additive" sums
+                   the dot weights per pixel and then scales the sums onto
+                   the color scheme, so dense data stays readable.
+        normalize -> additive mode only: curve applied to the sums before
+                   scaling, one of "linear", "log" or "sqrt", or "auto",
+                   see tune().
+        clip    -> additive mode only: percentile (0-100] of the non-empty
+                   pixels that maps to full density; denser pixels
+                   saturate.  100 scales to the densest pixel.
+        weights -> optional weight for each point, as a list or a float32
+                   buffer.  A point of weight w counts as w points stacked
+                   on top of each other, without the cost of stamping it w
+                   times.  Fractional weights are fine; points with a weight
+                   of 0 or less are skipped.
+        engine  -> "stamp" (the default) stamps a dot for every point.
+                   "binned" first sums the points landing on each pixel and
+                   then stamps each non-empty pixel once, weighted by its
+                   count.  When there are many more points than pixels it
+                   is much faster, at the cost of the points' sub-pixel
+                   positions.  "blur" sums the points per pixel and blurs
+                   the result with repeated box blurs, giving gaussian dots
+                   of about the same size.  Its cost depends only on the
+                   image size, so it wins for large dotsizes; it runs on a
+                   single thread.
+        projection -> how x,y map onto the image.  "linear" (the default)
+                   scales them straight onto the pixels.  "web_mercator"
+                   takes x,y as longitude, latitude and projects the
+                   latitude the way web maps do, inside the C code, so the
+                   image lines up with mercator basemaps; area stays in
+                   degrees.  Google Earth stretches overlays linearly over
+                   lat/long, so keep "linear" for saveKML().  Any other
+                   projection can be given as a function, which is called
+                   with a ctypes float array of x,y pairs (which numpy
+                   can wrap with numpy.frombuffer) and projects them in
+                   place.  The area corners are projected with it too.
+                   Without an area, the projected points are autoscaled
+                   instead, and the area kept for saveKML() is in
+                   projected coordinates.
+        palette -> return a palette ('P') image instead of RGBA: the density
+                   levels themselves, one byte per pixel, with the scheme
+                   as palette and the opacity as its transparency table.
+                   A quarter of the memory, and much smaller PNGs.
+        stats   -> a RenderStats to fill in with the timings and counters
+                   of this render.  One is made for the hook of the
+                   Heatmap if there is one.
+        finite  -> drop the points with a NaN or infinite coordinate or
+                   weight first.  They are never drawn either way, but are
+                   otherwise counted as points and as clipped.
+        autoclip -> without an area, autoscale to this (low, high) pair of
+                   percentiles of the x and y coordinates instead of their
+                   minimum and maximum, e.g. (0.1, 99.9), so a few outliers
+                   or junk points at 0,0 don't squeeze everything else into
+                   a corner.  The percentiles are found with a fixed size
+                   histogram refined over a few passes, so it stays linear
+                   in the number of points.
         """
-        self.dotsize = dotsize
-        self.opacity = opacity
-        self.size = size
-        self.points = points
+        if stats is None and self.hook is not None:
+            stats = RenderStats()
+        if stats is not None:
+            stats.times.clear()
 
-        if area is not None:
-            self.area = area
-            self.override = 1
+        self._checkScheme(scheme)
+        # the points are converted, autoscaled and tuned once, here
+        auto = "auto" in (dotsize, opacity, normalize)
+        (arrPoints, cPoints, arrWeights, renderArea, projection,
+         tuned) = self._prepare(points, weights, size, area, mode, projection,
+                                finite, autoclip, auto, stats)
+        if auto:
+            dotsize, opacity, normalize = _pickAuto(tuned, dotsize, opacity,
+                                                    normalize)
+        d = self._stamp(arrPoints, cPoints, arrWeights, size, dotsize,
+                        renderArea, threads, mode, normalize, clip, engine,
+                        projection, stats)
+
+        arrFinalImage = None
+        if palette:
+            start = time.time()
+            img = d._render(scheme, opacity, None, None, True, False)[0]
+            _clock(stats, "colorize", start)
         else:
-            self.area = ((0, 0), (0, 0))
-            self.override = 0
+            arrFinalImage = self._allocOutputBuffer(size)
+            d._colorize(scheme, opacity, arrFinalImage, stats=stats)
+            start = time.time()
+            img = Image.frombuffer('RGBA', (size[0], size[1]),
+                                   arrFinalImage, 'raw', 'RGBA', 0, 1)
+            _clock(stats, "frombuffer", start)
+        d._warnSaturated()
+        if stats is not None:
+            stats._count(d, arrFinalImage)
+
+        # publish the finished render in one go, so saveKML() never sees
+        # the image of one call with the area of another.  area is the one
+        # rendered with, as given or as autoscaled by the C code.
+        with self._lock:
+            self.dotsize = dotsize
+            self.opacity = opacity
+            self.size = size
+            self.points = points
+            self.area = d.area
+            self.override = int(area is not None)
+            self.img = img
+
+        if self.hook is not None:
+            self.hook(stats)
+        return img
+
+    def heatmap_bytes(self, points, format="png", compress_level=6,
+                      scheme="classic", opacity=128, palette=False,
+                      crop=False, **options):
+        """
+        Render a heatmap straight to encoded image bytes, for serving.
+
+        format         -> "png" or "webp"
+        compress_level -> 0 (fastest) to 9 (smallest).  For webp this picks
+                          the encoder effort of a lossless image.
+        palette        -> write a palette PNG, see heatmap().  Usually
+                          several times smaller.  webp ignores it.
+        crop           -> encode only the box the points were stamped on and
+                          return (bytes, (left, upper)), the offset of the
+                          box in the full image; (None, None) if nothing is
+                          visible.  See Density.render().
+        The other arguments are as for heatmap().  PNGs are encoded from
+        the C output buffer with zlib, without building a PIL image.  An
+        image where nothing is visible gets a shared, already encoded
+        transparent image without encoding anything.  Unlike heatmap(),
+        this doesn't keep the render for saveKML().
+        """
+        if "auto" in (opacity, options.get('dotsize'),
+                      options.get('normalize')):
+            # tune here, and hand density() the converted points, which it
+            # wraps without copying, and the area, so it doesn't autoscale
+            # them again
+            (points, cPoints, options['weights'], options['area'],
+             options['projection'], tuned) = \
+                self._prepare(points, options.get('weights'),
+                              options.get('size', (1024, 1024)),
+                              options.get('area'),
+                              options.get('mode', "multiply"),
+                              options.get('projection', "linear"),
+                              options.get('finite', False),
+                              options.get('autoclip'), True)
+            options['finite'] = False
+            (options['dotsize'], opacity,
+             options['normalize']) = _pickAuto(tuned,
+                                               options.get('dotsize', 150),
+                                               opacity,
+                                               options.get('normalize',
+                                                           "linear"))
+        d = self.density(points, **options)
+        return d.encode(scheme, opacity, format, compress_level,
+                        palette=palette, crop=crop)
+
+    def render_many(self, jobs, workers=4):
+        """
+        Render many heatmaps at once on a pool of threads.  Each render
+        spends nearly all of its time in the C library without holding the
+        GIL, so the renders run in parallel on multiple cores.
+
+        jobs    -> iterable of jobs.  A job is either a points list as passed
+                   to heatmap(), or a tuple (points, options) where options
+                   is a dict of keyword arguments for heatmap().
+        workers -> number of threads to render with.
+
+        Returns the list of images in the same order as jobs.  If a job
+        fails, the first failure is raised after all jobs have finished.
+        """
+        if workers < 1:
+            raise Exception("workers must be at least 1.")
+
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        errors = [None] * len(jobs)
+        queue = Queue.Queue()
+        for ndx, job in enumerate(jobs):
+            queue.put(ndx)
+
+        def worker():
+            while True:
+                try:
+                    ndx = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                job = jobs[ndx]
+                if (isinstance(job, tuple) and len(job) == 2 and
+                        isinstance(job[1], dict)):
+                    points, options = job
+                else:
+                    points, options = job, {}
+                try:
+                    results[ndx] = self.heatmap(points, **options)
+                except Exception, e:
+                    errors[ndx] = e
+
+        pool = [threading.Thread(target=worker)
+                for x in range(min(workers, len(jobs)))]
+        for t in pool:
+            t.daemon = True
+            t.start()
+        for t in pool:
+            t.join()
 
-        if scheme not in self.schemes():
+        for e in errors:
+            if e is not None:
+                raise e
+        return results
+
+    def density(self, points, dotsize=150, size=(1024, 1024), area=None, threads=1,
+                mode="multiply", normalize="linear", clip=100, weights=None,
+                engine="stamp", projection="linear", stats=None, finite=False,
+                autoclip=None):
+        """
+        Compute the grayscale density of points without colorizing it.  The
+        returned Density can be rendered any number of times with different
+        schemes and opacities; each render is a single pass over the pixels
+        and doesn't stamp the points again:
+
+            d = hm.density(pts)
+            fire = d.render(scheme="fire")
+            pbj = d.render(scheme="pbj", opacity=200)
+
+        Arguments are as for heatmap(), including "auto" for dotsize and
+        normalize.  Without an area, the bounds are taken from the points,
+        as heatmap() does.  stats, if given, gets the time spent on the
+        points and the density.
+        """
+        (arrPoints, cPoints, arrWeights, area, projection,
+         tuned) = self._prepare(points, weights, size, area, mode, projection,
+                                finite, autoclip,
+                                "auto" in (dotsize, normalize), stats)
+        if dotsize == "auto":
+            dotsize = tuned['dotsize']
+        if normalize == "auto":
+            normalize = tuned['normalize']
+        return self._stamp(arrPoints, cPoints, arrWeights, size, dotsize,
+                           area, threads, mode, normalize, clip, engine,
+                           projection, stats)
+
+    def _stamp(self, arrPoints, cPoints, arrWeights, size, dotsize, area,
+               threads, mode, normalize, clip, engine, projection, stats):
+        """ the Density of points already through _prepare() """
+        start = time.time()
+        d = Density(self, size, dotsize, area, threads, mode, normalize, clip,
+                    engine, projection)
+        d._add(arrPoints, cPoints, arrWeights)
+        _clock(stats, "density", start)
+
+        if stats is not None:
+            stats.peakBytes = ctypes.sizeof(arrPoints)
+            if arrWeights is not None:
+                stats.peakBytes += ctypes.sizeof(arrWeights)
+        return d
+
+    def accumulator(self, size=(1024, 1024), dotsize=150, area=None, threads=1,
+                    mode="multiply", normalize="linear", clip=100,
+                    engine="stamp", projection="linear"):
+        """
+        Return a Density that points can be added to in chunks, for data
+        sets too large to hold in memory at once.  Only the width x height
+        density buffer is kept between chunks:
+
+            acc = hm.accumulator(size=(1024, 1024), area=((0, 0), (1, 1)))
+            for chunk in reader:
+                acc.add(chunk)
+            img = acc.render(scheme="fire", opacity=128)
+
+        The other arguments are as for heatmap().  area is required,
+        since autoscaling needs to see every point before the first one is
+        drawn.  Adding all the points in chunks gives the same image as
+        passing them to heatmap() in one go with the same area.
+        """
+        if area is None:
+            raise Exception("accumulator() requires an area.")
+        return Density(self, size, dotsize, area, threads, mode, normalize,
+                       clip, engine, projection)
+
+    def tune(self, points, size=(1024, 1024), area=None, weights=None,
+             mode="multiply", projection="linear", percentile=95,
+             finite=False, autoclip=None):
+        """
+        Pick a dotsize, opacity and normalize curve for rendering points,
+        instead of tweaking them over several renders.  This is what
+        heatmap() does with "auto" for any of them.  Returns a dict with
+        the three.
+
+        The points are counted on a coarse grid over the image by the C
+        code, without stamping anything, and the densest cells decide the
+        dotsize:
+
+        dotsize   -> as big as possible while the cells at percentile of
+                     the non-empty ones stay short of saturating, so the
+                     render doesn't come out as a blob.  Between 4 and a
+                     quarter of the image.  A second count with cells the
+                     size of that dot refines it.
+        opacity   -> from 224 when the dots cover little of the image down
+                     to 128 when they cover all of it, so sparse points
+                     show and dense ones leave the background readable.
+        normalize -> for additive mode, "log" when the densest cell holds
+                     20 times the points of the median one, "sqrt" from 4
+                     times, else "linear".
+
+        Data too dense to stay unsaturated even at the smallest dotsize
+        renders better in additive mode.  The arguments are as for
+        heatmap().
+        """
+        (arrPoints, cPoints, arrWeights, area, projection,
+         tuned) = self._prepare(points, weights, size, area, mode, projection,
+                                finite, autoclip)
+        return self._tune(arrPoints, cPoints, arrWeights, size, area, mode,
+                          projection, percentile)
+
+    # log of the density level tune() aims the dense cells at, short of the
+    # 0x10 where pixels count as saturated
+    _TUNE_LEVEL = math.log(0x20 / 255.0)
+    # log of the multiplier of a dot, summed over the dot and divided by
+    # dotsize squared: a pixel under n points per square pixel darkens to
+    # 255 * exp(n * _DOT_LOG * dotsize ** 2) on average
+    _DOT_LOG = -0.146
+    _TUNE_DOTSIZES = (4, 1.0 / 4)
+    # cells per side of the first counting grid, and at most
+    _TUNE_CELLS = (32, 256)
+
+    def _tune(self, arrPoints, cPoints, arrWeights, size, area, mode,
+              projection, percentile=95):
+        # a Density does the checking and projecting; dotsize 1 is never
+        # stamped
+        d = Density(self, size, 1, area, projection=projection)
+        if callable(projection):
+            arrPoints = _project(projection, arrPoints)
+
+        smallest = self._TUNE_DOTSIZES[0]
+        largest = max(1, int(min(size) * self._TUNE_DOTSIZES[1]))
+        cell = max(size) / float(self._TUNE_CELLS[0])
+        dotsize = None
+        for x in range(2):
+            cw = min(self._TUNE_CELLS[1], max(1, int(round(size[0] / cell))))
+            ch = min(self._TUNE_CELLS[1], max(1, int(round(size[1] / cell))))
+            cells = (ctypes.c_float * (cw * ch))()
+            d._check(self._heatmap.countCells(ctypes.byref(d._info),
+                                              arrPoints, arrWeights, cPoints,
+                                              cells, cw, ch))
+            counts = sorted([c for c in cells if c > 0])
+            if not counts:
+                # nothing lands on the image
+                return {'dotsize': 150, 'opacity': 128, 'normalize': "linear"}
+
+            perPixel = (_percentile(counts, percentile) * cw * ch /
+                        float(size[0] * size[1]))
+            dotsize = math.sqrt(self._TUNE_LEVEL / (self._DOT_LOG * perPixel))
+            dotsize = max(1, min(largest, max(smallest, int(dotsize))))
+            cell = dotsize
+
+        coverage = len(counts) / float(cw * ch)
+        spread = counts[-1] / _percentile(counts, 50)
+        normalize = "linear"
+        if mode == "additive" and spread >= 20:
+            normalize = "log"
+        elif mode == "additive" and spread >= 4:
+            normalize = "sqrt"
+        return {'dotsize': dotsize,
+                'opacity': int(round(224 - 96 * coverage)),
+                'normalize': normalize}
+
+    def _prepare(self, points, weights, size, area, mode, projection,
+                 finite=False, autoclip=None, tune=False, stats=None):
+        """ convert the points, without the non-finite ones with finite,
+        autoscale if there is no area and with tune, tune() for them.
+        returns the converted points, their length and weights, the area,
+        the projection to render with and the tuning, or None.  a
+        projection function is autoscaled after: the points are projected
+        here and rendered "linear" over their projected bounds """
+        start = time.time()
+        arrPoints, cPoints, arrWeights = self._convertPoints(points, weights)
+        if finite:
+            arrPoints, cPoints, arrWeights = self._finite(arrPoints, cPoints,
+                                                          arrWeights)
+        if cPoints < 2:
+            raise Exception("No points to compute the density of.")
+        start = _clock(stats, "convertPoints", start)
+
+        if area is None:
+            if callable(projection):
+                arrPoints = _project(projection, arrPoints)
+                projection = "linear"
+            area = self._bounds(arrPoints, cPoints, autoclip)
+            start = _clock(stats, "getBounds", start)
+
+        tuned = None
+        if tune:
+            tuned = self._tune(arrPoints, cPoints, arrWeights, size, area,
+                               mode, projection)
+            _clock(stats, "tune", start)
+        return arrPoints, cPoints, arrWeights, area, projection, tuned
+
+    def _checkScheme(self, scheme):
+        if scheme not in colorschemes.schemes:
             tmp = "Unknown color scheme: %s.  Available schemes: %s" % (
                 scheme, self.schemes())
             raise Exception(tmp)
 
-        arrPoints = self._convertPoints(points)
-        arrScheme = self._convertScheme(scheme)
-        arrFinalImage = self._allocOutputBuffer()
-
-        ret = self._heatmap.tx(
-            arrPoints, len(points) * 2, size[0], size[1], dotsize,
-            arrScheme, arrFinalImage, opacity, self.override,
-            ctypes.c_float(self.area[0][0]), ctypes.c_float(
-                self.area[0][1]),
-            ctypes.c_float(self.area[1][0]), ctypes.c_float(self.area[1][1]))
+    def _bounds(self, arrPoints, cPoints, autoclip=None):
+        """ min/max x & y of converted points, or their autoclip
+        percentiles, computed by the C code """
+        inf = _Info()
+        if autoclip is None:
+            self._heatmap.getBounds(ctypes.byref(inf), arrPoints, cPoints)
+        else:
+            low, high = autoclip
+            if not 0 <= low < high <= 100:
+                raise Exception("autoclip must be a (low, high) pair of "
+                                "percentiles in [0, 100].")
+            self._heatmap.getBoundsClipped(ctypes.byref(inf), arrPoints,
+                                           cPoints, ctypes.c_float(low / 100.0),
+                                           ctypes.c_float(high / 100.0))
+        if inf.result.status == _Result.INVALID:
+            raise Exception("No finite points to autoscale to.")
+        if inf.result.status != _Result.OK:
+            raise Exception(_Result.ERRORS.get(
+                inf.result.status, "Unexpected error during processing."))
+        return ((inf.minX, inf.minY), (inf.maxX, inf.maxY))
 
-        if not ret:
+    def _finite(self, arrPoints, cPoints, arrWeights):
+        """ the points and weights without the ones with a NaN or infinite
+        coordinate or weight, copied by the C code if there are any """
+        outPoints = (ctypes.c_float * cPoints)()
+        outWeights = None
+        if arrWeights is not None:
+            outWeights = (ctypes.c_float * len(arrWeights))()
+        kept = self._heatmap.compactFinite(arrPoints, arrWeights, cPoints,
+                                           outPoints, outWeights)
+        if kept < 0:
             raise Exception("Unexpected error during processing.")
+        if kept == cPoints:
+            return arrPoints, cPoints, arrWeights
+        arrPoints = (ctypes.c_float * kept).from_buffer(outPoints)
+        if outWeights is not None:
+            outWeights = (ctypes.c_float * (kept / 2)).from_buffer(outWeights)
+        return arrPoints, kept, outWeights
+
+    def _allocOutputBuffer(self, size):
+        return (ctypes.c_ubyte * (size[0] * size[1] * 4))()
+
+    def _convertPoints(self, pts, weights=None):
+        """ flatten the list of tuples, convert into ctypes array.
+        returns the array, the number of floats in it and the ctypes
+        array of weights, or None if the points aren't weighted """
+
+        arr_pts = self._bufferFloats(pts, 2)
+        if arr_pts is not None:
+            cPoints = len(arr_pts)
+        else:
+            flat = []
+            if weights is None and len(pts) and len(pts[0]) == 3:
+                weights = []
+                for i, j, w in pts:
+                    flat.append(i)
+                    flat.append(j)
+                    weights.append(w)
+            else:
+                for i, j in pts:
+                    flat.append(i)
+                    flat.append(j)
+            #build array of input points
+            cPoints = len(flat)
+            arr_pts = (ctypes.c_float * cPoints)(*flat)
+
+        if weights is None:
+            return arr_pts, cPoints, None
+
+        arr_w = self._bufferFloats(weights, 1)
+        if arr_w is None:
+            weights = list(weights)
+            arr_w = (ctypes.c_float * len(weights))(*weights)
+        if len(arr_w) != cPoints / 2:
+            raise Exception("Got %d weights for %d points." % (
+                len(arr_w), cPoints / 2))
+        return arr_pts, cPoints, arr_w
 
-        self.img = Image.frombuffer('RGBA', (self.size[0], self.size[1]), 
-                                    arrFinalImage, 'raw', 'RGBA', 0, 1)
-        return self.img
-
-    def _allocOutputBuffer(self):
-        return (ctypes.c_ubyte * (self.size[0] * self.size[1] * 4))()
-
-    def _convertPoints(self, pts):
-        """ flatten the list of tuples, convert into ctypes array """
-
-        #TODO is there a better way to do this??
-        flat = []
-        for i, j in pts:
-            flat.append(i)
-            flat.append(j)
-        #build array of input points
-        arr_pts = (ctypes.c_float * (len(pts) * 2))(*flat)
-        return arr_pts
-
-    def _convertScheme(self, scheme):
-        """ flatten the list of RGB tuples, convert into ctypes array """
-
-        #TODO is there a better way to do this??
-        flat = []
-        for r, g, b in colorschemes.schemes[scheme]:
-            flat.append(r)
-            flat.append(g)
-            flat.append(b)
-        arr_cs = (
-            ctypes.c_int * (len(colorschemes.schemes[scheme]) * 3))(*flat)
-        return arr_cs
-
-    def _ranges(self, points):
-        """ walks the list of points and finds the
-        max/min x & y values in the set """
-        minX = points[0][0]
-        minY = points[0][1]
-        maxX = minX
-        maxY = minY
-        for x, y in points:
-            minX = min(x, minX)
-            minY = min(y, minY)
-            maxX = max(x, maxX)
-            maxY = max(y, maxY)
-
-        return ((minX, minY), (maxX, maxY))
+    def _bufferFloats(self, obj, per):
+        """ wrap the memory of a float32 buffer object (numpy array,
+        array.array('f'), mmap, ...) holding groups of per floats in a
+        ctypes array without copying.  returns None if obj has to go
+        through the tuple path instead """
+
+        if isinstance(obj, (list, tuple)):
+            return None
+
+        # numpy arrays describe themselves; anything that is not contiguous
+        # float32 (float64, strided views, ...) is walked as rows
+        iface = getattr(obj, '__array_interface__', None)
+        if iface is not None:
+            shape = iface['shape']
+            if (iface['typestr'] != self._FLOAT32 or iface.get('strides') or
+                    not (shape[-1:] == (per,) or len(shape) == 1)):
+                return None
+        elif getattr(obj, 'typecode', 'f') != 'f':
+            return None
+
+        try:
+            nbytes = len(buffer(obj))
+        except TypeError:
+            return None
+        if nbytes % (per * ctypes.sizeof(ctypes.c_float)):
+            raise Exception("Buffer must contain groups of %d float32s." % per)
+
+        arrType = ctypes.c_float * (nbytes / ctypes.sizeof(ctypes.c_float))
+        try:
+            return arrType.from_buffer(obj)
+        except TypeError:
+            # read-only buffer: a single memcpy, still no per-point work
+            return arrType.from_buffer_copy(obj)
 
     def saveKML(self, kmlFile):
         """
@@ -177,16 +688,18 @@ class Heatmap:
 
         kmlFile ->  output filename for the KML.
         """
-        if self.img is None:
+        with self._lock:
+            img, area = self.img, self.area
+
+        if img is None:
             raise Exception("Must first run heatmap() to generate image file.")
 
         tilePath = os.path.splitext(kmlFile)[0] + ".png"
-        self.img.save(tilePath)
+        img.save(tilePath)
 
-        if self.override:
-            ((east, south), (west, north)) = self.area
-        else:
-            ((east, south), (west, north)) = self._ranges(self.points)
+        # the bounds the image was rendered with, as the C code found them
+        # if they weren't given
+        ((east, south), (west, north)) = area
 
         bytes = self.KML % (tilePath, north, south, east, west)
         file(kmlFile, "w").write(bytes)
@@ -196,3 +709,468 @@ class Heatmap:
         Return a list of available color scheme names.
         """
         return colorschemes.valid_schemes()
+
+
+# encoded images with nothing visible, by (size, format, compress_level)
+_emptyImages = {}
+
+def _emptyImage(size, format="png", compress_level=6):
+    """ the shared encoded fully transparent image of size """
+    key = (tuple(size), format, compress_level)
+    data = _emptyImages.get(key)
+    if data is None:
+        pixels = (ctypes.c_ubyte * (size[0] * size[1] * 4))()
+        data = _encode(pixels, size, format, compress_level)
+        _emptyImages[key] = data
+    return data
+
+def _encode(pixels, size, format, compress_level):
+    """ encode a buffer of RGBA pixels """
+    if format == "png":
+        return _encodePNG(pixels, size, compress_level)
+    img = Image.frombuffer('RGBA', (size[0], size[1]), pixels,
+                           'raw', 'RGBA', 0, 1)
+    out = StringIO()
+    img.save(out, "WEBP", lossless=True, method=compress_level * 6 / 9)
+    return out.getvalue()
+
+def _pngChunk(tag, data):
+    return (struct.pack(">I", len(data)) + tag + data +
+            struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+def _encodePNG(pixels, size, compress_level, palette=None, alpha=None):
+    """ PNG of a buffer of RGBA pixels, or of palette indexes if a palette
+    (and its alpha table) is given.  the rows aren't filtered: the large
+    transparent runs of a heatmap compress better without, and it is
+    several times faster than PIL's adaptive filtering """
+    if palette is None:
+        stride = size[0] * 4
+        header = struct.pack(">IIBBBBB", size[0], size[1], 8, 6, 0, 0, 0)
+        chunks = ""
+    else:
+        stride = size[0]
+        header = struct.pack(">IIBBBBB", size[0], size[1], 8, 3, 0, 0, 0)
+        chunks = _pngChunk("PLTE", palette) + _pngChunk("tRNS", alpha)
+    raw = buffer(pixels)
+    # every row starts with its filter type, 0 for none
+    rows = "".join(["\x00" + raw[i:i + stride]
+                    for i in xrange(0, len(raw), stride)])
+    return ("\x89PNG\r\n\x1a\n" + _pngChunk("IHDR", header) + chunks +
+            _pngChunk("IDAT", zlib.compress(rows, compress_level)) +
+            _pngChunk("IEND", ""))
+
+
+def _clock(stats, stage, start):
+    """ record the time since start as stage of stats, if there are stats.
+    returns the current time, to start the next stage from """
+    now = time.time()
+    if stats is not None:
+        stats.times[stage] = stats.times.get(stage, 0.0) + now - start
+    return now
+
+def _project(projection, arrPoints):
+    """ run a projection function over a copy of the points """
+    projected = (ctypes.c_float * len(arrPoints))()
+    ctypes.memmove(projected, arrPoints, ctypes.sizeof(projected))
+    projection(projected)
+    return projected
+
+def _percentile(values, percentile):
+    """ the value at percentile of sorted values """
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+def _pickAuto(tuned, dotsize, opacity, normalize):
+    """ the tuned value for each of dotsize, opacity and normalize that is
+    "auto" """
+    if dotsize == "auto":
+        dotsize = tuned['dotsize']
+    if opacity == "auto":
+        opacity = tuned['opacity']
+    if normalize == "auto":
+        normalize = tuned['normalize']
+    return dotsize, opacity, normalize
+
+
+class RenderStats(object):
+    """
+    Timings and counters of a render, filled in by Heatmap.heatmap():
+
+        stats = RenderStats()
+        img = hm.heatmap(pts, stats=stats)
+        print stats.times['density'], stats.clipped
+
+    times     -> seconds spent in each stage the render went through:
+                 convertPoints, getBounds (only when autoscaling), tune
+                 (only for "auto" options), density (stamping the points),
+                 convertScheme (looking up the
+                 scheme's color table), colorize and frombuffer.  A palette
+                 render has no convertScheme or frombuffer.
+    points    -> points rendered
+    clipped   -> points whose center fell outside the area.  Their dots
+                 can still reach into the image.
+    histogram -> number of pixels at each of the 256 density levels, from
+                 0 (full density) to 0xff (empty)
+    touched   -> pixels with any density
+    saturated -> pixels over 95% density.  When over 80% of the pixels
+                 are, heatmap() warns with a SaturationWarning.
+    peakBytes -> bytes of the points, density and image buffers the render
+                 held at once
+    """
+
+    STAGES = ("convertPoints", "getBounds", "tune", "density",
+              "convertScheme", "colorize", "frombuffer")
+
+    def __init__(self):
+        self.times = {}
+        self.points = 0
+        self.clipped = 0
+        self.histogram = [0] * 256
+        self.touched = 0
+        self.saturated = 0
+        self.peakBytes = 0
+
+    def _count(self, d, arrFinalImage):
+        """ take the counters of the render of d into arrFinalImage, which
+        is None for a palette render """
+        self.points = d.count
+        self.clipped = d.clipped
+        # counted by the C code as it colorized
+        self.histogram = list(d._info.result.histogram)
+        self.touched = sum(self.histogram[:0xff])
+        self.saturated = sum(self.histogram[:0x10])
+        self.peakBytes += ctypes.sizeof(d.pixels)
+        if d.sums is not None:
+            self.peakBytes += ctypes.sizeof(d.sums)
+        if arrFinalImage is not None:
+            self.peakBytes += ctypes.sizeof(arrFinalImage)
+
+    def total(self):
+        """ seconds spent in all the stages """
+        return sum(self.times.values())
+
+    def asdict(self):
+        """ the timings and counters as a dict, e.g. for json """
+        return {'times': dict(self.times),
+                'points': self.points,
+                'clipped': self.clipped,
+                'histogram': list(self.histogram),
+                'touched': self.touched,
+                'saturated': self.saturated,
+                'peakBytes': self.peakBytes}
+
+    def __repr__(self):
+        return "<RenderStats %d points in %.3fs>" % (self.points,
+                                                     self.total())
+
+
+class Density(object):
+    """
+    Grayscale density buffer of a heatmap, as built by the C code before it
+    is colorized: one byte per pixel, row by row, 0xff where there are no
+    points and darker where they overlap.  Use Heatmap.density() or
+    Heatmap.accumulator() to create one.
+
+    pixels is the underlying ctypes array, which can be handed to anything
+    that takes a buffer (numpy.frombuffer, ...) without a copy.  In additive
+    mode the sums live in sums, a ctypes float array, and pixels holds
+    their levels as of the last render() or tobytes().
+
+    Rendering warns with a SaturationWarning when most of the image is at
+    full density.  clipped and histogram() tell how the points landed.
+    """
+
+    # image formats encode() can write
+    FORMATS = ("png", "webp")
+
+    # mode, normalization curve, engine and projection names, and their
+    # values in heatmap.c
+    MODES = {"multiply": 0, "additive": 1}
+    CURVES = {"linear": 0, "log": 1, "sqrt": 2}
+    ENGINES = {"stamp": 0, "binned": 1, "blur": 2}
+    PROJECTIONS = {"linear": 0, "web_mercator": 1}
+
+    def __init__(self, hm, size, dotsize, area, threads=1, mode="multiply",
+                 normalize="linear", clip=100, engine="stamp",
+                 projection="linear"):
+        if threads < 1:
+            raise Exception("threads must be at least 1.")
+        if mode not in self.MODES:
+            raise Exception("Unknown mode: %s.  Available modes: %s" % (
+                mode, self.MODES.keys()))
+        if engine not in self.ENGINES:
+            raise Exception("Unknown engine: %s.  Available engines: %s" % (
+                engine, self.ENGINES.keys()))
+        if not (callable(projection) or projection in self.PROJECTIONS):
+            raise Exception("Unknown projection: %s.  Available: %s" % (
+                projection, self.PROJECTIONS.keys()))
+        self._checkNormalize(normalize, clip)
+
+        self.size = size
+        self.dotsize = dotsize
+        self.area = area
+        self.mode = mode
+        self.normalize = normalize
+        self.clip = clip
+        self.engine = engine
+        self.projection = projection
+        self.count = 0
+        self._hm = hm
+        # a projection function runs in python, the C code then maps the
+        # projected points linearly
+        bounds = (area[0][0], area[0][1], area[1][0], area[1][1])
+        native = 0
+        if callable(projection):
+            bounds = _project(projection, (ctypes.c_float * 4)(*bounds))
+        else:
+            native = self.PROJECTIONS[projection]
+        self._info = _Info(bounds[0], bounds[1], bounds[2], bounds[3],
+                           size[0], size[1], dotsize, threads,
+                           self.ENGINES[engine], native)
+        self.pixels = (ctypes.c_ubyte * (size[0] * size[1]))()
+        ctypes.memset(self.pixels, 0xff, ctypes.sizeof(self.pixels))
+        self.sums = None
+        if mode == "additive":
+            self.sums = (ctypes.c_float * (size[0] * size[1]))()
+        self._lock = threading.Lock()
+
+    def _checkNormalize(self, normalize, clip):
+        if normalize not in self.CURVES:
+            raise Exception("Unknown normalize curve: %s.  Available: %s" % (
+                normalize, self.CURVES.keys()))
+        if not 0 < clip <= 100:
+            raise Exception("clip must be a percentile in (0, 100].")
+
+    def add(self, points, weights=None):
+        """
+        Stamp a chunk of points into the buffer.  Takes the same kinds of
+        points and weights as Heatmap.heatmap().
+        """
+        arrPoints, cPoints, arrWeights = self._hm._convertPoints(points,
+                                                                 weights)
+        if cPoints:
+            self._add(arrPoints, cPoints, arrWeights)
+
+    def _add(self, arrPoints, cPoints, arrWeights=None, shiftX=0):
+        """ stamp converted points.  shiftX moves them along x as they are
+        stamped, without copying them: the area is moved the other way for
+        the call.  It is in the coordinates the C code maps, so after a
+        projection function """
+        if callable(self.projection):
+            arrPoints = _project(self.projection, arrPoints)
+        with self._lock:
+            minX, maxX = self._info.minX, self._info.maxX
+            self._info.minX = minX - shiftX
+            self._info.maxX = maxX - shiftX
+            try:
+                if self.sums is not None:
+                    ret = self._hm._heatmap.addWeights(
+                        ctypes.byref(self._info), arrPoints, arrWeights,
+                        cPoints, self.sums)
+                else:
+                    ret = self._hm._heatmap.addDensity(
+                        ctypes.byref(self._info), arrPoints, arrWeights,
+                        cPoints, self.pixels)
+            finally:
+                self._info.minX, self._info.maxX = minX, maxX
+            self._check(ret)
+            self.count += cPoints / 2
+
+    def _levels(self, normalize=None, clip=None):
+        """ in additive mode, scale the summed weights onto the density
+        levels in pixels.  must be called with the lock held """
+        if self.sums is None:
+            return
+        if normalize is None:
+            normalize = self.normalize
+        if clip is None:
+            clip = self.clip
+        self._checkNormalize(normalize, clip)
+
+        self._check(self._hm._heatmap.normalizeWeights(
+            ctypes.byref(self._info), self.sums, self.pixels,
+            self.CURVES[normalize], ctypes.c_float(clip)))
+
+    def _check(self, ret):
+        """ raise the failure of a call into the C code, if it failed """
+        if not ret:
+            raise Exception(_Result.ERRORS.get(
+                self._info.result.status,
+                "Unexpected error during processing."))
+
+    def _countLevels(self):
+        """ histogram the levels without colorizing them.  must be called
+        with the lock held """
+        self._check(self._hm._heatmap.countLevels(ctypes.byref(self._info),
+                                                  self.pixels))
+
+    def _warnSaturated(self):
+        """ warn if the last colorize or count found the image saturated """
+        if self._info.result.status == _Result.SATURATED:
+            # stacklevel 3 blames the caller of render(), heatmap(), ...
+            warnings.warn("80% of output pixels are over 95% density.  "
+                          "Decrease dotsize or increase output image "
+                          "resolution?", SaturationWarning, stacklevel=3)
+
+    @property
+    def clipped(self):
+        """ points added so far whose center fell outside the area """
+        return self._info.result.clipped
+
+    def histogram(self):
+        """
+        Number of pixels at each of the 256 density levels, from 0 (full
+        density) to 0xff (empty), counted by the C code.
+        """
+        with self._lock:
+            self._levels()
+            self._countLevels()
+            return list(self._info.result.histogram)
+
+    def getbbox(self):
+        """
+        The (left, upper, right, lower) box of the pixels points have been
+        stamped on, tracked by the C code as it stamps, or None if there
+        are none.  Everything outside the box is empty.
+        """
+        x0, y0, x1, y1 = self._info.dirty
+        if x1 <= x0:
+            return None
+        return (x0, y0, x1, y1)
+
+    def _levelBytes(self, box):
+        """ the density levels in box, row by row.  must be called with
+        the lock held """
+        x0, y0, x1, y1 = box
+        width = self.size[0]
+        levels = buffer(self.pixels)
+        if x0 == 0 and x1 == width:
+            return levels[y0 * width:y1 * width]
+        return "".join([levels[y * width + x0:y * width + x1]
+                        for y in xrange(y0, y1)])
+
+    def render(self, scheme="classic", opacity=128, normalize=None, clip=None,
+               palette=False, crop=False):
+        """
+        Colorize the density buffer into an RGBA image.  The buffer is left
+        as it is, so more points can be added afterwards.  In additive mode
+        normalize and clip override the values the Density was created
+        with, for this render only.  With palette, return a copy of the
+        buffer as a palette ('P') image instead, see Heatmap.heatmap().
+
+        Only the pixels in getbbox() are ever colorized, the rest are
+        filled with the color of the empty level.  With crop, the
+        image is just that box, returned with its offset in the full image
+        as (image, (left, upper)), or (None, None) if nothing was stamped.
+        Much cheaper when the points cover a small part of a big canvas.
+        """
+        img, offset = self._render(scheme, opacity, normalize, clip, palette,
+                                   crop)
+        self._warnSaturated()
+        if crop:
+            return img, offset
+        return img
+
+    def _render(self, scheme, opacity, normalize, clip, palette, crop):
+        """ render() without the warning.  returns the image and its
+        offset """
+        self._hm._checkScheme(scheme)
+        with self._lock:
+            self._levels(normalize, clip)
+            box = (0, 0, self.size[0], self.size[1])
+            if crop:
+                box = self.getbbox()
+                if box is None:
+                    return None, None
+            size = (box[2] - box[0], box[3] - box[1])
+
+            if palette:
+                self._countLevels()
+                img = Image.frombytes('P', size, self._levelBytes(box))
+                img.putpalette(colorschemes.rgb(scheme))
+                img.info['transparency'] = colorschemes.alpha(opacity)
+            else:
+                arrFinalImage = (ctypes.c_ubyte * (size[0] * size[1] * 4))()
+                self._colorizeBox(colorschemes.rgba(scheme, opacity),
+                                  arrFinalImage, crop)
+                img = Image.frombuffer('RGBA', size, arrFinalImage,
+                                       'raw', 'RGBA', 0, 1)
+        return img, box[:2]
+
+    def _colorize(self, scheme, opacity, arrFinalImage, normalize=None,
+                  clip=None, stats=None):
+        start = time.time()
+        lut = colorschemes.rgba(scheme, opacity)
+        start = _clock(stats, "convertScheme", start)
+        with self._lock:
+            self._levels(normalize, clip)
+            self._colorizeBox(lut, arrFinalImage)
+        _clock(stats, "colorize", start)
+
+    def _colorizeBox(self, lut, arrFinalImage, crop=False):
+        """ colorize through lut, as built by colorschemes.rgba(), into
+        the full size arrFinalImage, or with crop into one the
+        size of getbbox().  must be called with the lock held """
+        colorize = self._hm._heatmap.colorizeLUT
+        if crop:
+            colorize = self._hm._heatmap.colorizeCrop
+        self._check(colorize(ctypes.byref(self._info), self.pixels, lut,
+                             arrFinalImage))
+
+    def encode(self, scheme="classic", opacity=128, format="png",
+               compress_level=6, normalize=None, clip=None, palette=False,
+               crop=False):
+        """
+        Colorize the density buffer and encode it, as for
+        Heatmap.heatmap_bytes().  normalize, clip and crop are as for
+        render(); with crop the bytes are returned with their offset.
+        """
+        self._hm._checkScheme(scheme)
+        if format not in self.FORMATS:
+            raise Exception("Unknown format: %s.  Available formats: %s" % (
+                format, self.FORMATS))
+
+        palette = palette and format == "png"
+        with self._lock:
+            self._levels(normalize, clip)
+            box = self.getbbox()
+            levels = box and self._levelBytes(box)
+            # colorize makes every level over 252 transparent
+            if not (opacity & 0xff and levels and
+                    levels.translate(None, "\xfd\xfe\xff")):
+                if crop:
+                    return None, None
+                return _emptyImage(self.size, format, compress_level)
+
+            if not crop:
+                box = (0, 0, self.size[0], self.size[1])
+            size = (box[2] - box[0], box[3] - box[1])
+            if palette:
+                self._countLevels()
+            if palette and not crop:
+                levels = self._levelBytes(box)
+            elif not palette:
+                arrFinalImage = (ctypes.c_ubyte * (size[0] * size[1] * 4))()
+                self._colorizeBox(colorschemes.rgba(scheme, opacity),
+                                  arrFinalImage, crop)
+
+        self._warnSaturated()
+        if palette:
+            data = _encodePNG(levels, size, compress_level,
+                              colorschemes.rgb(scheme),
+                              colorschemes.alpha(opacity))
+        else:
+            data = _encode(arrFinalImage, size, format, compress_level)
+        if crop:
+            return data, box[:2]
+        return data
+
+    def tobytes(self):
+        """ copy of the density buffer as a string of bytes """
+        with self._lock:
+            self._levels()
+            return ctypes.string_at(self.pixels, ctypes.sizeof(self.pixels))
+
+    def image(self):
+        """ copy of the density buffer as a grayscale ('L') PIL image """
+        return Image.frombytes('L', (self.size[0], self.size[1]),
+                               self.tobytes())
@@ -0,0 +1,231 @@
+"""
+Serve heatmap tiles over HTTP, rendering each one the first time it is
+asked for.
+
+    from heatmap import server
+    tiles = server.TileServer(pts, cacheDir="/var/cache/heatmap", dotsize=40)
+    tiles.serve(port=8080)
+
+answers GET /z/x/y.png with a 256x256 PNG.  scheme, dotsize and opacity
+can be overridden per request in the query string, e.g.
+/12/655/1430.png?scheme=fire, within QUERY_LIMITS so that one request
+can't tie up the host.  GET /stats returns the cache and render
+counters as JSON.
+
+Encoded tiles are kept in memory in a least recently used cache bounded by
+bytes and, if cacheDir is given, on disk under a directory per point set,
+so a restarted server doesn't render them again.  Tiles no dot reaches are
+answered with the shared transparent PNG and never cached.
+"""
+
+import os
+import time
+import json
+import urlparse
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import colorschemes
+from heatmap import Heatmap, _emptyImage
+from tiles import TileIndex, TILE_SIZE
+from cache import LRUCache, _atomicWrite
+
+# upper bounds, in milliseconds, of the render latency histogram buckets.
+# the last bucket counts everything slower.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+EMPTY_TILE = _emptyImage((TILE_SIZE, TILE_SIZE))
+
+
+class TileServer(object):
+    """
+    Render tiles of a point set on demand, with caching.
+
+    points     -> (lon, lat) points, anything Heatmap.heatmap() takes
+    weights    -> optional weight for each point, as for Heatmap.heatmap()
+    zoom       -> deepest zoom level of the point index, see TileIndex
+    cacheBytes -> size of the in-memory tile cache
+    cacheDir   -> directory for the on-disk tile cache, or None for none
+    libpath    -> path to the heatmap shared library, as for Heatmap()
+    options    -> defaults for the tiles: dotsize, opacity, scheme, mode,
+                  normalize, clip and engine, as for Heatmap.heatmap()
+    """
+
+    # options a request may override in its query string, and their types
+    QUERY_OPTIONS = {'scheme': str, 'dotsize': int, 'opacity': int}
+    # and the range of the numeric ones.  the cost of a tile grows with the
+    # square of dotsize, and every opacity builds its own color table.
+    QUERY_LIMITS = {'dotsize': (1, 2 * TILE_SIZE), 'opacity': (0, 255)}
+
+    def __init__(self, points, weights=None, zoom=16,
+                 cacheBytes=64 * 1024 * 1024, cacheDir=None, libpath=None,
+                 **options):
+        self.hm = Heatmap(libpath)
+        self.index = TileIndex(self.hm, points, weights, zoom)
+        self.options = options
+        self.cache = LRUCache(cacheBytes)
+        self.cacheDir = cacheDir
+
+        # tiles on disk are keyed by the points they were rendered from
+        digest = hashlib.sha1(buffer(self.index.points))
+        if self.index.weights is not None:
+            digest.update(buffer(self.index.weights))
+        self.dataset = digest.hexdigest()
+
+        self.renders = 0
+        self.empty = 0
+        self.diskHits = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+    def tile(self, z, x, y, **overrides):
+        """
+        PNG bytes of tile x, y at zoom z.  overrides replace the default
+        options for this tile, and must be within QUERY_LIMITS.
+        """
+        n = 1 << z
+        if not (0 <= z <= 30 and 0 <= x < n and 0 <= y < n):
+            raise Exception("No tile %d/%d/%d." % (z, x, y))
+        for name, value in overrides.items():
+            if name not in self.QUERY_LIMITS:
+                continue
+            low, high = self.QUERY_LIMITS[name]
+            if not low <= value <= high:
+                raise Exception("%s must be in [%d, %d]." % (name, low, high))
+
+        options = dict(self.options)
+        options.update(overrides)
+        if options.get('scheme', 'classic') not in colorschemes.schemes:
+            raise Exception("Unknown color scheme: %s." % options['scheme'])
+
+        key = (self.dataset, tuple(sorted(options.items())), z, x, y)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+
+        path = self._diskPath(options, z, x, y)
+        if path is not None and os.path.isfile(path):
+            data = file(path, "rb").read()
+            with self._lock:
+                self.diskHits += 1
+            self.cache.put(key, data)
+            return data
+
+        start = time.time()
+        data = self.index.encode(z, x, y, **options)
+        if data is EMPTY_TILE:
+            with self._lock:
+                self.empty += 1
+            return data
+        self._record(time.time() - start)
+
+        self.cache.put(key, data)
+        if path is not None:
+            _atomicWrite(path, data)
+        return data
+
+    def _diskPath(self, options, z, x, y):
+        if self.cacheDir is None:
+            return None
+        # the other options are part of the name, so changing any of them
+        # doesn't serve stale tiles
+        rest = "-".join(["%s=%s" % item for item in sorted(options.items())
+                         if item[0] not in self.QUERY_OPTIONS])
+        style = "%s-%d-%d%s" % (options.get('scheme', 'classic'),
+                                options.get('dotsize', 150),
+                                options.get('opacity', 128),
+                                rest and "-" + rest)
+        return os.path.join(self.cacheDir, self.dataset, style, str(z), str(x),
+                            "%d.png" % y)
+
+    def _record(self, seconds):
+        ms = seconds * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for ndx, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                bucket = ndx
+                break
+        with self._lock:
+            self.renders += 1
+            self.latency[bucket] += 1
+
+    def stats(self):
+        """
+        Cache and render counters:
+
+        hits, misses -> lookups in the memory cache
+        diskHits     -> misses found in the disk cache
+        renders      -> tiles rendered
+        empty        -> requests for tiles that no dot reaches
+        bytes, tiles -> size of the memory cache
+        latency      -> render time histogram, a list of [upper bound in ms,
+                        count]; the last bound is None
+        """
+        with self._lock:
+            latency = [[bound, count] for bound, count in
+                       zip(LATENCY_BUCKETS + (None,), self.latency)]
+            return {'hits': self.cache.hits,
+                    'misses': self.cache.misses,
+                    'diskHits': self.diskHits,
+                    'renders': self.renders,
+                    'empty': self.empty,
+                    'bytes': self.cache.bytes,
+                    'tiles': len(self.cache),
+                    'latency': latency}
+
+    def httpServer(self, host="", port=8080):
+        """ a threaded HTTP server answering tile requests, not yet
+        started; call its serve_forever() """
+        tiles = self
+
+        class Handler(_TileHandler):
+            server_tiles = tiles
+
+        return _ThreadedHTTPServer((host, port), Handler)
+
+    def serve(self, host="", port=8080):
+        """ serve tiles over HTTP until interrupted """
+        self.httpServer(host, port).serve_forever()
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_tiles = None
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/stats":
+            return self._reply(200, "application/json",
+                               json.dumps(self.server_tiles.stats()))
+
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 3 or not parts[2].endswith(".png"):
+            return self._reply(404, "text/plain", "Not found.\n")
+        try:
+            z, x, y = int(parts[0]), int(parts[1]), int(parts[2][:-4])
+            overrides = {}
+            for name, values in urlparse.parse_qs(url.query).items():
+                if name in TileServer.QUERY_OPTIONS:
+                    overrides[name] = TileServer.QUERY_OPTIONS[name](values[-1])
+            data = self.server_tiles.tile(z, x, y, **overrides)
+        except Exception, e:
+            return self._reply(400, "text/plain", "%s\n" % e)
+        self._reply(200, "image/png", data)
+
+    def _reply(self, code, contentType, body):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the counters in /stats replace the per-request log
+        pass
@@ -0,0 +1,292 @@
+"""
+Render heatmaps as XYZ ("slippy map") tiles for web maps.
+
+Points are (longitude, latitude) pairs.  A TileIndex sorts them once by the
+web mercator tile they fall in, so every tile's points are a contiguous run
+of the sorted buffer.  Rendering a tile hands the C code only the runs of
+the tile and of the neighbours close enough for a dot to reach into it, and
+each tile is rendered with its own lon/lat bounds as area so neighbouring
+tiles line up at the seams.  Tiles with no points in reach are skipped
+without calling into C.
+
+    from heatmap import tiles
+    tiles.generate(pts, "tiles", range(0, 13), dotsize=40, scheme="fire")
+
+writes tiles/z/x/y.png for every tile that has something on it.
+
+Tiles are rendered with the web_mercator projection, so they line up with
+the usual basemaps.  In additive mode each tile is normalized on its own,
+so use multiply mode (the default) when the tiles need to match at the
+seams.
+"""
+
+import os
+import math
+import ctypes
+import bisect
+import threading
+import Queue
+
+from heatmap import Heatmap, Density, _emptyImage
+
+TILE_SIZE = 256
+# deepest zoom the index can sort at; keys are 2 * zoom bits
+MAX_INDEX_ZOOM = 24
+# key of points outside the mercator range, which sort last
+NO_TILE = 0xffffffffffffffff
+
+
+def tileBounds(z, x, y):
+    """ ((west, south), (east, north)) of tile x, y at zoom z """
+    n = 2.0 ** z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return ((x / n * 360.0 - 180.0, lat(y + 1)),
+            ((x + 1) / n * 360.0 - 180.0, lat(y)))
+
+
+def _spreadBits(v):
+    """ spread the bits of v apart, for a morton code """
+    key = 0
+    bit = 0
+    while v:
+        key |= (v & 1) << (2 * bit)
+        v >>= 1
+        bit += 1
+    return key
+
+
+def _compactBits(key):
+    """ inverse of _spreadBits, for the even bits of key """
+    v = 0
+    bit = 0
+    while key:
+        v |= (key & 1) << bit
+        key >>= 2
+        bit += 1
+    return v
+
+
+class TileIndex(object):
+    """
+    Points sorted by the web mercator tile they fall in at zoom, ready to
+    render tiles from.
+
+    hm      -> Heatmap to render with
+    points  -> (lon, lat) points, anything Heatmap.heatmap() takes.  They
+               are copied once into the index; points outside the mercator
+               range (|lat| > 85.05) are dropped.
+    weights -> optional weight for each point, as for Heatmap.heatmap()
+    zoom    -> the deepest zoom level the index sorts points at.  Tiles at
+               deeper zooms can still be rendered, but get handed all the
+               points of their ancestor tile at zoom.
+    """
+
+    def __init__(self, hm, points, weights=None, zoom=16):
+        if not 0 <= zoom <= MAX_INDEX_ZOOM:
+            raise Exception("zoom must be in [0, %d]." % MAX_INDEX_ZOOM)
+
+        arrPoints, cPoints, arrWeights = hm._convertPoints(points, weights)
+        # sorting is done in place, so never on the caller's buffer
+        self.points = (ctypes.c_float * cPoints)()
+        ctypes.memmove(self.points, arrPoints, ctypes.sizeof(self.points))
+        self.weights = None
+        if arrWeights is not None:
+            self.weights = (ctypes.c_float * len(arrWeights))()
+            ctypes.memmove(self.weights, arrWeights,
+                           ctypes.sizeof(self.weights))
+
+        self.keys = (ctypes.c_ulonglong * (cPoints / 2))()
+        if not hm._heatmap.sortTiles(self.points, self.weights, cPoints,
+                                     zoom, self.keys):
+            raise Exception("Unexpected error during processing.")
+
+        self.hm = hm
+        self.zoom = zoom
+        self.count = bisect.bisect_left(self.keys, NO_TILE)
+
+    def _range(self, z, x, y):
+        """ [start, end) of the sorted points in tile x, y at zoom z, or
+        in its ancestor at the index zoom if z is deeper """
+        shift = self.zoom - z
+        if shift < 0:
+            x >>= -shift
+            y >>= -shift
+            shift = 0
+        key = (_spreadBits(x) | (_spreadBits(y) << 1)) << (2 * shift)
+        return (bisect.bisect_left(self.keys, key, 0, self.count),
+                bisect.bisect_left(self.keys, key + (1 << (2 * shift)), 0,
+                                   self.count))
+
+    def tiles(self, z):
+        """ iterate over the (x, y) of the tiles holding points at zoom z,
+        which can't be deeper than the index zoom """
+        if not 0 <= z <= self.zoom:
+            raise Exception("zoom must be in [0, %d]." % self.zoom)
+        shift = 2 * (self.zoom - z)
+        i = 0
+        while i < self.count:
+            key = self.keys[i] >> shift
+            yield int(_compactBits(key)), int(_compactBits(key >> 1))
+            i = bisect.bisect_left(self.keys, (key + 1) << shift, i,
+                                   self.count)
+
+    def reach(self, dotsize):
+        """ how many tiles away a dot of dotsize can still draw into """
+        return int(math.ceil((dotsize / 2.0 + 1) / TILE_SIZE))
+
+    def _slices(self, z, x, y, reach):
+        """ [start, end) runs of the points of the tile and the neighbours
+        within reach, merged where they touch and without the empty ones,
+        each with the longitude shift that moves it next to the tile """
+        n = 1 << z
+        ranges = set()
+        for ty in range(max(0, y - reach), min(n, y + reach + 1)):
+            for tx in range(x - reach, x + reach + 1):
+                # the world wraps around horizontally
+                start, end = self._range(z, tx % n, ty)
+                if start < end:
+                    ranges.add((start, end, (tx // n) * 360.0))
+
+        merged = []
+        for start, end, wrap in sorted(ranges, key=lambda r: (r[2], r[0])):
+            if merged and wrap == merged[-1][2] and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]), wrap)
+            else:
+                merged.append((start, end, wrap))
+        return merged
+
+    def density(self, z, x, y, dotsize=150, mode="multiply",
+                normalize="linear", clip=100, engine="stamp"):
+        """
+        Density of tile x, y at zoom z, or None if no dot reaches into it.
+        Arguments are as for Heatmap.heatmap().
+        """
+        slices = self._slices(z, x, y, self.reach(dotsize))
+        if not slices:
+            return None
+
+        d = Density(self.hm, (TILE_SIZE, TILE_SIZE), dotsize,
+                    tileBounds(z, x, y), 1, mode, normalize, clip, engine,
+                    "web_mercator")
+        floatSize = ctypes.sizeof(ctypes.c_float)
+        for start, end, wrap in slices:
+            arrPoints = (ctypes.c_float * ((end - start) * 2)).from_buffer(
+                self.points, start * 2 * floatSize)
+            arrWeights = None
+            if self.weights is not None:
+                arrWeights = (ctypes.c_float * (end - start)).from_buffer(
+                    self.weights, start * floatSize)
+            # neighbours across the antimeridian are shifted by the C code,
+            # which at zooms 0 and 1 is nearly all of them
+            d._add(arrPoints, len(arrPoints), arrWeights, wrap)
+        return d
+
+    def render(self, z, x, y, dotsize=150, opacity=128, scheme="classic",
+               mode="multiply", normalize="linear", clip=100, engine="stamp"):
+        """
+        Render tile x, y at zoom z as a 256x256 RGBA image, or return None
+        if no dot reaches into it.  Arguments are as for Heatmap.heatmap().
+        """
+        d = self.density(z, x, y, dotsize, mode, normalize, clip, engine)
+        if d is None:
+            return None
+        return d.render(scheme, opacity)
+
+    def encode(self, z, x, y, dotsize=150, opacity=128, scheme="classic",
+               mode="multiply", normalize="linear", clip=100, engine="stamp",
+               format="png", compress_level=6):
+        """
+        Tile x, y at zoom z as encoded image bytes, as for
+        Heatmap.heatmap_bytes().  Tiles with nothing visible on them are
+        the shared transparent image for their format.
+        """
+        d = self.density(z, x, y, dotsize, mode, normalize, clip, engine)
+        if d is None:
+            return _emptyImage((TILE_SIZE, TILE_SIZE), format, compress_level)
+        return d.encode(scheme, opacity, format, compress_level)
+
+    def occupied(self, z, dotsize=150):
+        """ set of the (x, y) of tiles at zoom z that a dot can reach """
+        n = 1 << z
+        reach = self.reach(dotsize)
+        if z > self.zoom:
+            raise Exception("zoom must be in [0, %d]." % self.zoom)
+
+        found = set()
+        for x, y in self.tiles(z):
+            for ty in range(max(0, y - reach), min(n, y + reach + 1)):
+                for tx in range(x - reach, x + reach + 1):
+                    found.add((tx % n, ty))
+        return found
+
+
+def generate(points, outdir, zooms, workers=4, weights=None, libpath=None,
+             **options):
+    """
+    Write the XYZ tile pyramid of points to outdir/z/x/y.png.
+
+    points  -> (lon, lat) points, anything Heatmap.heatmap() takes
+    outdir  -> directory to write the tiles under
+    zooms   -> iterable of zoom levels to render, at most 24
+    workers -> number of threads to render tiles with.  The C code doesn't
+               hold the GIL, so tiles render in parallel.
+    weights -> optional weight for each point, as for Heatmap.heatmap()
+    libpath -> path to the heatmap shared library, as for Heatmap()
+    options -> dotsize, opacity, scheme, mode, normalize, clip and engine,
+               as for Heatmap.heatmap()
+
+    Only tiles that a dot reaches into are rendered and written.  Returns
+    the number of tiles written.
+    """
+    if workers < 1:
+        raise Exception("workers must be at least 1.")
+    zooms = sorted(set(zooms))
+    if not zooms:
+        return 0
+
+    index = TileIndex(Heatmap(libpath), points, weights, zoom=zooms[-1])
+    dotsize = options.get('dotsize', 150)
+
+    queue = Queue.Queue()
+    for z in zooms:
+        for x, y in sorted(index.occupied(z, dotsize)):
+            queue.put((z, x, y))
+
+    written = [0]
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                z, x, y = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                img = index.render(z, x, y, **options)
+                if img is None:
+                    continue
+                path = os.path.join(outdir, str(z), str(x))
+                with lock:
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                img.save(os.path.join(path, "%d.png" % y))
+                with lock:
+                    written[0] += 1
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+
+    pool = [threading.Thread(target=worker) for x in range(workers)]
+    for t in pool:
+        t.daemon = True
+        t.start()
+    for t in pool:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return written[0]
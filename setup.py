@@ -6,8 +6,8 @@ from distutils.command.install import install
 from distutils.command.build_ext import build_ext
 
 # sorry for this, welcome feedback on the "right" way.
-# shipping pre-compiled bainries on windows, have
-# to hack things up here.
+# on windows the DLLs are built with build.bat from a VS
+# command prompt first, and copied in at install time.
 
 class mybuild(build_ext):
     def run(self):
@@ -25,12 +25,16 @@ class post_install(install):
         # site-packages (or wherever the module is being installed)
         if "nt" in os.name:
             basedir = os.path.dirname(__file__)
+            if not glob.glob(os.path.join(basedir, "*.dll")):
+                raise Exception("No cHeatmap DLLs to install; run build.bat "
+                                "from a Visual Studio command prompt first.")
             for f in glob.glob(os.path.join(basedir, "*.dll")):
                 src = os.path.join(basedir, f)
                 dst = os.path.join(self.install_lib, f)
                 open(dst, "wb").write(open(src, "rb").read())
 
-cHeatmap = Extension('cHeatmap', sources=['heatmap/heatmap.c', ])
+cHeatmap = Extension('cHeatmap', sources=['heatmap/heatmap.c', ],
+                     libraries=['pthread', ])
 
 setup(name='heatmap',
       version="2.2.1",
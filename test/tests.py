@@ -1,4 +1,14 @@
+import os
+import array
+import ctypes
 import random
+import math
+import warnings
+import threading
+import json
+import shutil
+import urllib2
+from cStringIO import StringIO
 
 from PIL import Image
 
@@ -8,6 +18,11 @@ except ImportError:
     import unittest
 
 import heatmap
+from heatmap import batch
+from heatmap import tiles
+from heatmap import server
+from heatmap import cache
+from heatmap import bench
 from heatmap import colorschemes
 
 class TestHeatmap(unittest.TestCase):
@@ -57,9 +72,944 @@ class TestHeatmap(unittest.TestCase):
         self.heatmap.saveKML("06-wash-dc.kml")
         self.assertTrue(isinstance(img, Image.Image))
 
+    def test_heatmap_buffer_points(self):
+        pts = [(random.random(), random.random()) for x in range(400)]
+        flat = array.array('f', [c for pt in pts for c in pt])
+        expected = self.heatmap.heatmap(pts).tobytes()
+        img = self.heatmap.heatmap(flat)
+        self.assertEqual(img.tobytes(), expected)
+
+    def test_heatmap_numpy_points(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest("numpy not installed")
+        pts = numpy.random.random((400, 2)).astype(numpy.float32)
+        expected = self.heatmap.heatmap([tuple(pt) for pt in pts]).tobytes()
+        self.assertEqual(self.heatmap.heatmap(pts).tobytes(), expected)
+        # float64 arrays still work, through the slow path
+        img = self.heatmap.heatmap(pts.astype(numpy.float64))
+        self.assertEqual(img.tobytes(), expected)
+
+    def test_stamp(self):
+        # a lone dot on white is its stamp: the falloff computed from the
+        # middle of the sub-pixel cell the point falls in
+        dotsize = 10
+        half = dotsize / 2
+        subpix = min(max((256 + dotsize - 1) / dotsize, 4), 32)
+        radius = math.sqrt(2 * (dotsize / 2.0) ** 2) / 2
+        px, py = 40.3, 61.8
+        d = self.heatmap.density([(px / 100, 1 - py / 100)], dotsize=dotsize,
+                                 size=(100, 100), area=((0, 0), (1, 1)))
+        levels = bytearray(d.tobytes())
+        x0, y0 = int(math.floor(px)), int(math.floor(py))
+        cx = half + (int((px - x0) * subpix) + 0.5) / subpix
+        cy = half + (int((py - y0) * subpix) + 0.5) / subpix
+        x0 -= half
+        y0 -= half
+        for y in range(100):
+            for x in range(100):
+                u, v = x - x0, y - y0
+                expected = 255
+                if 0 <= u < dotsize and 0 <= v < dotsize:
+                    dist = math.sqrt((u - cx) ** 2 + (v - cy) ** 2)
+                    expected = min(int(200 * (dist / radius) + 50), 255)
+                self.assertEqual(levels[y * 100 + x], expected, (x, y))
+
+        # a point a hair below 0 lands at the very end of the pixel before,
+        # which is the last sub-pixel stamp, not one past it
+        y = 1 - 0.999 / 100.0
+        for x in (-1e-30, -1e-7):
+            img = self.heatmap.heatmap([(x, y)], dotsize=10, size=(100, 100),
+                                       area=((0, 0), (1, 1)))
+            expected = self.heatmap.heatmap([(-1e-5 / 100, y)], dotsize=10,
+                                            size=(100, 100),
+                                            area=((0, 0), (1, 1)))
+            self.assertEqual(img.tobytes(), expected.tobytes())
+
+    def test_heatmap_threads(self):
+        pts = [(random.random(), random.random()) for x in range(2000)]
+        pts.append((-0.1, 1.1))
+        expected = self.heatmap.heatmap(pts, dotsize=40).tobytes()
+        for threads in (2, 3, 7):
+            img = self.heatmap.heatmap(pts, dotsize=40, threads=threads)
+            self.assertEqual(img.tobytes(), expected)
+        img = self.heatmap.heatmap(pts, size=(64, 5), threads=16)
+        self.assertEqual(img.size, (64, 5))
+        self.assertRaises(Exception, self.heatmap.heatmap, pts, threads=0)
+
+    def test_render_releases_gil(self):
+        pts = array.array('f', [random.random() for x in range(200000)])
+        ticks = [0]
+        stop = []
+
+        def spin():
+            while not stop:
+                ticks[0] += 1
+
+        spinner = threading.Thread(target=spin)
+        spinner.start()
+        try:
+            # warm up, so the spinner is running before we measure
+            self.heatmap.heatmap(pts[:2000], dotsize=10)
+            args = self._txArgs(pts)
+            before = ticks[0]
+            self.heatmap._heatmap.tx(*args)
+            during = ticks[0] - before
+        finally:
+            stop.append(True)
+            spinner.join()
+        # with the GIL held for the call, the spinner could not have moved
+        self.assertTrue(during > 1000, during)
+
+    def _txArgs(self, pts):
+        """ the 13 arguments of tx() rendering pts """
+        arrPoints, cPoints, arrWeights = self.heatmap._convertPoints(pts)
+        flat = [c for color in colorschemes.schemes["classic"] for c in color]
+        return (arrPoints, cPoints, 1024, 1024, 150,
+                (ctypes.c_int * len(flat))(*flat),
+                self.heatmap._allocOutputBuffer((1024, 1024)), 128, 0,
+                ctypes.c_float(0), ctypes.c_float(0),
+                ctypes.c_float(0), ctypes.c_float(0))
+
+    def test_render_many(self):
+        jobs = []
+        for x in range(12):
+            pts = [(random.random(), random.random()) for y in range(300)]
+            jobs.append((pts, {'dotsize': 10 + x, 'size': (200, 100 + x)}))
+        jobs.append([(random.random(), random.random()) for y in range(300)])
+
+        imgs = self.heatmap.render_many(jobs, workers=4)
+        self.assertEqual(len(imgs), len(jobs))
+        for job, img in zip(jobs, imgs):
+            if isinstance(job, tuple):
+                expected = self.heatmap.heatmap(job[0], **job[1])
+            else:
+                expected = self.heatmap.heatmap(job)
+            self.assertEqual(img.size, expected.size)
+            self.assertEqual(img.tobytes(), expected.tobytes())
+
+        jobs.append(([], {}))
+        self.assertRaises(Exception, self.heatmap.render_many, jobs)
+
+    def test_accumulator(self):
+        pts = [(random.random(), random.random()) for x in range(3000)]
+        area = ((0, 0), (1, 1))
+        expected = self.heatmap.heatmap(pts, dotsize=50, area=area,
+                                        scheme="fire", opacity=200)
+
+        acc = self.heatmap.accumulator(dotsize=50, area=area, threads=2)
+        for start in range(0, len(pts), 700):
+            acc.add(pts[start:start+700])
+        acc.add([])
+        self.assertEqual(acc.count, len(pts))
+        img = acc.render(scheme="fire", opacity=200)
+        self.assertEqual(img.tobytes(), expected.tobytes())
+
+        self.assertRaises(Exception, self.heatmap.accumulator)
+        self.assertRaises(Exception, acc.render, scheme="nonesuch")
+
+    def test_density_recolor(self):
+        pts = [(random.random() * 10, random.random() * 5) for x in range(2000)]
+        d = self.heatmap.density(pts, dotsize=60, size=(400, 300))
+        xs, ys = zip(*pts)
+        for got, expected in zip(d.area, ((min(xs), min(ys)),
+                                          (max(xs), max(ys)))):
+            self.assertAlmostEqual(got[0], expected[0], places=5)
+            self.assertAlmostEqual(got[1], expected[1], places=5)
+        for scheme in self.heatmap.schemes():
+            for opacity in (64, 255):
+                expected = self.heatmap.heatmap(pts, dotsize=60, size=(400, 300),
+                                                scheme=scheme, opacity=opacity)
+                img = d.render(scheme=scheme, opacity=opacity)
+                self.assertEqual(img.tobytes(), expected.tobytes())
+
+        raw = d.tobytes()
+        self.assertEqual(len(raw), 400 * 300)
+        self.assertEqual(raw, bytes(buffer(d.pixels)))
+        self.assertEqual(d.image().mode, 'L')
+        self.assertEqual(d.image().tobytes(), raw)
+        self.assertRaises(Exception, self.heatmap.density, [])
+
+    def test_heatmap_additive(self):
+        pts = [(random.gauss(0.5, 0.05), random.gauss(0.5, 0.05))
+               for x in range(5000)]
+        area = ((0, 0), (1, 1))
+        img = self.heatmap.heatmap(pts, dotsize=25, area=area, mode="additive")
+        img.save("08-additive.png")
+        pixels = img.tobytes()
+        # the densest pixel maps to the top of the scheme and the far
+        # corners stay transparent
+        top = colorschemes.schemes["classic"][0]
+        self.assertTrue(pixels.find(bytearray(top + (128,))) >= 0)
+        self.assertEqual(pixels[3], '\x00')
+
+        acc = self.heatmap.accumulator(dotsize=25, area=area, mode="additive")
+        acc.add(pts[:2500])
+        acc.add(pts[2500:])
+        self.assertEqual(acc.render().tobytes(), pixels)
+
+        # with 2 threads the float sums can't differ either
+        d = self.heatmap.density(pts, dotsize=25, area=area, threads=2,
+                                 mode="additive")
+        self.assertEqual(d.render().tobytes(), pixels)
+        for normalize in ("log", "sqrt"):
+            expected = self.heatmap.heatmap(pts, dotsize=25, area=area,
+                                            mode="additive", normalize=normalize)
+            self.assertEqual(d.render(normalize=normalize).tobytes(),
+                             expected.tobytes())
+
+        # clipping at a percentile saturates more of the image
+        levels = d.tobytes()
+        clipped = self.heatmap.density(pts, dotsize=25, area=area,
+                                       mode="additive", clip=50).tobytes()
+        self.assertTrue(clipped.count('\x00') > levels.count('\x00'))
+
+        self.assertRaises(Exception, self.heatmap.heatmap, pts, mode="nonesuch")
+        self.assertRaises(Exception, self.heatmap.heatmap, pts,
+                          mode="additive", normalize="nonesuch")
+        self.assertRaises(Exception, self.heatmap.heatmap, pts,
+                          mode="additive", clip=0)
+
+    def test_heatmap_weights(self):
+        pts = [(random.random(), random.random()) for x in range(300)]
+        counts = [random.randint(0, 4) for x in range(300)]
+        repeated = []
+        for pt, count in zip(pts, counts):
+            repeated.extend([pt] * count)
+        area = ((0, 0), (1, 1))
+
+        for mode, tolerance in (("multiply", 8), ("additive", 1)):
+            expected = self.heatmap.density(repeated, dotsize=40, area=area,
+                                            mode=mode).tobytes()
+            d = self.heatmap.density(pts, dotsize=40, area=area, mode=mode,
+                                     weights=counts)
+            got = d.tobytes()
+            diffs = [abs(ord(a) - ord(b)) for a, b in zip(got, expected)]
+            self.assertTrue(max(diffs) <= tolerance, (mode, max(diffs)))
+
+            triples = [(x, y, w) for (x, y), w in zip(pts, counts)]
+            d = self.heatmap.density(triples, dotsize=40, area=area, mode=mode)
+            self.assertEqual(d.tobytes(), got)
+            d = self.heatmap.density(pts, dotsize=40, area=area, mode=mode,
+                                     weights=array.array('f', counts))
+            self.assertEqual(d.tobytes(), got)
+
+        # large and fractional weights, which share quantized pow tables,
+        # stay within a level of the exact power of a lone dot
+        single = bytearray(self.heatmap.density([(0.5, 0.5)], dotsize=40,
+                                                area=area).tobytes())
+        for weight in (0.37, 2.5, 300, 999.9):
+            got = bytearray(self.heatmap.density([(0.5, 0.5)], dotsize=40,
+                                                 area=area,
+                                                 weights=[weight]).tobytes())
+            for level, value in zip(single, got):
+                exact = int(255 * (level / 255.0) ** weight + 0.5)
+                self.assertTrue(abs(value - exact) <= 1,
+                                (weight, level, value, exact))
+
+        img = self.heatmap.heatmap(pts, weights=[1] * len(pts))
+        self.assertEqual(img.tobytes(), self.heatmap.heatmap(pts).tobytes())
+        self.assertRaises(Exception, self.heatmap.heatmap, pts, weights=[1, 2])
+
+    def test_heatmap_binned(self):
+        # many points per pixel: binning stamps each pixel once
+        pts = [(random.randint(0, 49) + 0.5, random.randint(0, 49) + 0.5)
+               for x in range(20000)]
+        area = ((0, 0), (50, 50))
+        for mode, tolerance in (("multiply", 8), ("additive", 1)):
+            expected = self.heatmap.density(pts, dotsize=9, size=(50, 50),
+                                            area=area, mode=mode).tobytes()
+            d = self.heatmap.density(pts, dotsize=9, size=(50, 50), area=area,
+                                     mode=mode, engine="binned", threads=3)
+            got = d.tobytes()
+            diffs = [abs(ord(a) - ord(b)) for a, b in zip(got, expected)]
+            self.assertTrue(max(diffs) <= tolerance, (mode, max(diffs)))
+
+        img = self.heatmap.heatmap(pts, engine="binned")
+        self.assertTrue(isinstance(img, Image.Image))
+        self.assertRaises(Exception, self.heatmap.heatmap, pts, engine="nonesuch")
+
+    def test_heatmap_blur(self):
+        area = ((0, 0), (200, 200))
+        d = self.heatmap.density([(100, 100)], dotsize=100, size=(200, 200),
+                                 area=area, engine="blur", mode="additive")
+        levels = d.tobytes()
+        # a lone dot peaks in its center, is round and fades out at the edge
+        self.assertEqual(levels[100 * 200 + 100], '\x00')
+        self.assertEqual(levels[100 * 200 + 70], levels[70 * 200 + 100])
+        self.assertTrue(levels[100 * 200 + 70] > levels[100 * 200 + 90])
+        self.assertEqual(levels[100 * 200 + 10], '\xff')
+        self.assertEqual(levels[0], '\xff')
+
+        pts = [(random.random(), random.random()) for x in range(1000)]
+        for mode in ("multiply", "additive"):
+            img = self.heatmap.heatmap(pts, dotsize=400, engine="blur",
+                                       mode=mode)
+            img.save("09-blur-%s.png" % mode)
+            self.assertTrue(isinstance(img, Image.Image))
+
+    def test_heatmap_projection(self):
+        def mercY(lat):
+            return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+        def mercator(arr):
+            for i in range(1, len(arr), 2):
+                arr[i] = mercY(arr[i])
+
+        area = ((0, 0), (10, 80))
+        row = (1 - mercY(60) / mercY(80)) * 400
+        for projection in ("web_mercator", mercator):
+            d = self.heatmap.density([(5, 60)], dotsize=20, size=(100, 400),
+                                     area=area, projection=projection)
+            levels = list(bytearray(d.tobytes()))
+            darkest = levels.index(min(levels))
+            self.assertEqual(darkest % 100, 50)
+            self.assertTrue(abs(darkest / 100 - row) < 1)
+
+        pts = [(random.uniform(-20, 20), random.uniform(-70, 70))
+               for x in range(100)]
+        native = self.heatmap.heatmap(pts, dotsize=20, projection="web_mercator")
+        img = self.heatmap.heatmap(pts, dotsize=20, projection=mercator)
+        self.assertEqual(native.size, img.size)
+        self.assertRaises(Exception, self.heatmap.heatmap, pts,
+                          projection="nonesuch")
+
+        # without an area, a projection that isn't separable in x and y is
+        # autoscaled on the projected points, so none of them is clipped
+        def rotate(arr):
+            for i in range(0, len(arr), 2):
+                arr[i], arr[i + 1] = arr[i] - arr[i + 1], arr[i] + arr[i + 1]
+
+        def shrinkX(arr):
+            for i in range(0, len(arr), 2):
+                arr[i] *= math.cos(math.radians(arr[i + 1]))
+
+        pts = [(random.uniform(-20, 20), random.uniform(-70, 70))
+               for x in range(500)]
+        for projection in (rotate, shrinkX):
+            d = self.heatmap.density(pts, dotsize=20, size=(200, 200),
+                                     projection=projection)
+            self.assertEqual(d.clipped, 0)
+            img = self.heatmap.heatmap(pts, dotsize=20, size=(200, 200),
+                                       projection=projection)
+            self.assertEqual(img.tobytes(), d.render().tobytes())
+
+    def test_heatmap_zoomed(self):
+        # a small window onto points spread over much more, as when
+        # zooming into a national dataset
+        pts = [(random.uniform(-120, -70), random.uniform(25, 50))
+               for x in range(20000)]
+        area = ((-90, 35), (-88, 36.5))
+        # the points close enough to the window to draw into it, generously
+        near = [(x, y) for x, y in pts if -91 < x < -87 and 34 < y < 37.5]
+        for engine in ("stamp", "binned", "blur"):
+            for projection in ("linear", "web_mercator"):
+                options = dict(dotsize=40, size=(200, 150), area=area,
+                               threads=3, engine=engine, projection=projection)
+                stats = heatmap.RenderStats()
+                img = self.heatmap.heatmap(pts, stats=stats, **options)
+                expected = self.heatmap.heatmap(near, **options)
+                self.assertEqual(img.tobytes(), expected.tobytes())
+                inside = len([1 for x, y in pts
+                              if -90 < x < -88 and 35 < y < 36.5])
+                self.assertTrue(abs(stats.clipped - (len(pts) - inside)) <= 2,
+                                (stats.clipped, len(pts) - inside))
+
+        # an area with max < min mirrors the image, and still skips
+        flipped = self.heatmap.heatmap(pts, dotsize=40, size=(200, 150),
+                                       area=((-88, 35), (-90, 36.5)))
+        self.assertEqual(
+            flipped.tobytes(),
+            self.heatmap.heatmap(near, dotsize=40, size=(200, 150),
+                                 area=((-88, 35), (-90, 36.5))).tobytes())
+
+    def test_heatmap_bytes(self):
+        pts = [(random.random(), random.random()) for x in range(500)]
+        expected = self.heatmap.heatmap(pts, dotsize=40, size=(300, 200),
+                                        scheme="fire")
+        for format in ("png", "webp"):
+            data = self.heatmap.heatmap_bytes(pts, format=format,
+                                              compress_level=1, dotsize=40,
+                                              size=(300, 200), scheme="fire")
+            img = Image.open(StringIO(data))
+            self.assertEqual(img.format, format.upper())
+            # webp doesn't keep the color of transparent pixels
+            for got, want in zip(img.convert('RGBA').getdata(),
+                                 expected.getdata()):
+                self.assertEqual(got[3], want[3])
+                if want[3]:
+                    self.assertEqual(got, want)
+
+        # nothing visible: the shared empty image, without encoding
+        empty = self.heatmap.heatmap_bytes(pts, dotsize=40, size=(300, 200),
+                                           area=((5, 5), (6, 6)))
+        self.assertTrue(empty is self.heatmap.heatmap_bytes(
+            pts, opacity=0, dotsize=40, size=(300, 200)))
+        img = Image.open(StringIO(empty))
+        self.assertEqual(img.size, (300, 200))
+        self.assertEqual(img.getextrema()[3], (0, 0))
+        self.assertRaises(Exception, self.heatmap.heatmap_bytes, pts,
+                          format="gif")
+
+    def test_heatmap_palette(self):
+        pts = [(random.random(), random.random()) for x in range(500)]
+        expected = self.heatmap.heatmap(pts, dotsize=40, size=(300, 200),
+                                        scheme="pbj", opacity=200)
+        img = self.heatmap.heatmap(pts, dotsize=40, size=(300, 200),
+                                   scheme="pbj", opacity=200, palette=True)
+        self.assertEqual(img.mode, "P")
+        self.assertEqual(img.convert('RGBA').tobytes(), expected.tobytes())
+
+        out = StringIO()
+        img.save(out, "PNG")
+        self.assertEqual(Image.open(StringIO(out.getvalue())).convert(
+            'RGBA').tobytes(), expected.tobytes())
+
+        data = self.heatmap.heatmap_bytes(pts, dotsize=40, size=(300, 200),
+                                          scheme="pbj", opacity=200,
+                                          palette=True)
+        img = Image.open(StringIO(data))
+        self.assertEqual(img.mode, "P")
+        self.assertEqual(img.convert('RGBA').tobytes(), expected.tobytes())
+        self.assertTrue(len(data) < len(self.heatmap.heatmap_bytes(
+            pts, dotsize=40, size=(300, 200), scheme="pbj", opacity=200)))
+
+    def test_density_crop(self):
+        area = ((0, 0), (1000, 1000))
+        for engine in ("stamp", "binned", "blur"):
+            for mode in ("multiply", "additive"):
+                d = self.heatmap.accumulator(size=(1000, 1000), dotsize=50,
+                                             area=area, engine=engine,
+                                             mode=mode)
+                self.assertEqual(d.getbbox(), None)
+                self.assertEqual(d.render(crop=True), (None, None))
+                d.add([(300, 600), (320, 610)])
+                d.add([(400, 650)])
+                box = d.getbbox()
+                # image rows run top down
+                self.assertTrue(box[0] <= 285 and box[2] >= 415, box)
+                self.assertTrue(box[1] <= 335 and box[3] >= 415, box)
+                self.assertTrue(box[2] - box[0] <= 160, box)
+                self.assertTrue(box[3] - box[1] <= 160, box)
+
+                # nothing outside the box is drawn on
+                full = d.render(scheme="fire")
+                drawn = full.split()[3].getbbox()
+                self.assertTrue(drawn[0] >= box[0] and drawn[1] >= box[1] and
+                                drawn[2] <= box[2] and drawn[3] <= box[3])
+                # and it is the same empty color as the untouched pixels in
+                # the box, so no rectangle shows without the alpha
+                empty = colorschemes.rgb("fire")[0xff*3:] + "\x00"
+                self.assertEqual(full.getpixel((0, 0)), tuple(map(ord, empty)))
+                self.assertEqual(full.getpixel((0, 0)), full.getpixel(box[:2]))
+                img, offset = d.render(scheme="fire", crop=True)
+                self.assertEqual(offset, box[:2])
+                self.assertEqual(img.tobytes(), full.crop(box).tobytes())
+                img, offset = d.render(scheme="fire", crop=True, palette=True)
+                self.assertEqual(img.convert('RGBA').tobytes(),
+                                 full.crop(box).tobytes())
+
+        data, offset = self.heatmap.heatmap_bytes([(300, 600)], dotsize=50,
+                                                  size=(1000, 1000), area=area,
+                                                  crop=True)
+        img = Image.open(StringIO(data))
+        self.assertTrue(abs(offset[0] - 275) <= 1 and
+                        abs(offset[1] - 375) <= 1, offset)
+        self.assertEqual(img.size, (50, 50))
+        self.assertEqual(self.heatmap.heatmap_bytes(
+            [(300, 600)], area=((5, 5), (6, 6)), crop=True), (None, None))
+
+    def test_stats(self):
+        # 10 of the points are off the image, 20 saturate the middle
+        pts = [(random.random(), random.random()) for x in range(70)]
+        pts += [(0.5, 0.5)] * 20
+        pts += [(1.5 + random.random(), random.random()) for x in range(10)]
+        area = ((0, 0), (1, 1))
+        for engine in ("stamp", "binned", "blur"):
+            stats = heatmap.RenderStats()
+            img = self.heatmap.heatmap(pts, dotsize=20, size=(200, 100),
+                                       area=area, threads=3, engine=engine,
+                                       stats=stats)
+            self.assertEqual((stats.points, stats.clipped), (100, 10))
+            self.assertEqual(sorted(stats.times), sorted(
+                ["convertPoints", "density", "convertScheme", "colorize",
+                 "frombuffer"]))
+            self.assertTrue(0 < stats.saturated <= stats.touched <= 20000)
+            self.assertTrue(stats.peakBytes >= 200 * 100 * 5 + 800)
+
+            # a palette render counts the same pixels
+            palette = heatmap.RenderStats()
+            self.heatmap.heatmap(pts, dotsize=20, size=(200, 100), area=area,
+                                 threads=3, engine=engine, stats=palette,
+                                 palette=True)
+            self.assertEqual((palette.touched, palette.saturated),
+                             (stats.touched, stats.saturated))
+
+        seen = []
+        hm = heatmap.Heatmap(hook=seen.append)
+        hm.heatmap(pts, dotsize=20, size=(200, 100))
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0].clipped, 0)
+        self.assertTrue("getBounds" in seen[0].times)
+        self.assertEqual(json.loads(json.dumps(seen[0].asdict()))['points'],
+                         100)
+
+    def test_saturation(self):
+        pts = [(random.random(), random.random()) for x in range(200)]
+        for palette in (False, True):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                self.heatmap.heatmap(pts, dotsize=100, size=(100, 100),
+                                     palette=palette)
+                self.heatmap.heatmap(pts, dotsize=5, size=(100, 100),
+                                     palette=palette)
+            self.assertEqual([w.category for w in caught],
+                             [heatmap.SaturationWarning])
+            self.assertEqual(caught[0].filename, __file__.replace(".pyc", ".py"))
+
+        d = self.heatmap.density(pts, dotsize=100, size=(100, 50),
+                                 area=((0, 0), (0.5, 1)))
+        hist = d.histogram()
+        self.assertEqual(sum(hist), 5000)
+        self.assertTrue(sum(hist[:0x10]) > 4000)
+        self.assertTrue(d.clipped > 50)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", heatmap.SaturationWarning)
+            self.assertRaises(heatmap.SaturationWarning, d.render)
+
+        # the C code reports bad parameters instead of printing them
+        args = self._txArgs(pts)
+        result = heatmap.heatmap._Result()
+        # txResult() takes the threads and the result after those
+        ret = self.heatmap._heatmap.txResult(*(args[:1] + (0,) + args[2:] +
+                                               (1, ctypes.byref(result))))
+        self.assertEqual(ret, 0)
+        self.assertEqual(result.status, result.INVALID)
+        self.heatmap._heatmap.txResult(*(args + (1, ctypes.byref(result))))
+        self.assertTrue(result.status in (result.OK, result.SATURATED))
+        self.assertEqual(sum(result.histogram), 1024 * 1024)
+
+    def test_auto(self):
+        dense = array.array('f', [random.random() for x in range(40000)])
+        sparse = array.array('f', [random.random() for x in range(40)])
+        tuned = self.heatmap.tune(dense, size=(256, 256))
+        self.assertEqual(sorted(tuned), ["dotsize", "normalize", "opacity"])
+        self.assertTrue(tuned['dotsize'] <
+                        self.heatmap.tune(sparse, size=(256, 256))['dotsize'])
+        self.assertTrue(128 <= tuned['opacity'] <= 224)
+        self.assertEqual(tuned['normalize'], "linear")
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.heatmap.heatmap(dense, size=(256, 256))
+            self.assertEqual(len(caught), 1)
+            stats = heatmap.RenderStats()
+            img = self.heatmap.heatmap(dense, size=(256, 256),
+                                       dotsize="auto", opacity="auto",
+                                       stats=stats)
+            self.assertEqual(len(caught), 1)
+        self.assertTrue("tune" in stats.times)
+        self.assertTrue(stats.saturated < 256 * 256 * 0.8)
+        self.assertEqual(img.tobytes(), self.heatmap.heatmap(
+            dense, size=(256, 256), **tuned).tobytes())
+        data = self.heatmap.heatmap_bytes(dense, size=(256, 256),
+                                          dotsize="auto", opacity="auto")
+        self.assertEqual(Image.open(StringIO(data)).tobytes(), img.tobytes())
+        d = self.heatmap.density(dense, size=(256, 256), dotsize="auto")
+        self.assertEqual(d.dotsize, tuned['dotsize'])
+
+        # the points are converted once, however many options are "auto"
+        calls = []
+        convert = self.heatmap._convertPoints
+
+        def counted(*args):
+            calls.append(1)
+            return convert(*args)
+        self.heatmap._convertPoints = counted
+        self.heatmap.heatmap(dense, size=(256, 256), dotsize="auto",
+                             opacity="auto", palette=True)
+        self.assertEqual(len(calls), 1)
+        del self.heatmap._convertPoints
+
+        results = batch.render([(dense, {'size': (256, 256),
+                                         'dotsize': "auto",
+                                         'opacity': "auto"})], processes=1)
+        self.assertEqual(results[0].img.tobytes(), img.tobytes())
+
+        # a few dense clusters spread far beyond the median cell
+        clustered = [(random.gauss(0.5, 0.01), random.gauss(0.5, 0.01))
+                     for x in range(2000)]
+        clustered += [(random.random(), random.random()) for x in range(200)]
+        tuned = self.heatmap.tune(clustered, size=(256, 256),
+                                  area=((0, 0), (1, 1)), mode="additive")
+        self.assertTrue(tuned['normalize'] in ("sqrt", "log"), tuned)
+
+    def test_finite(self):
+        pts = [(random.random(), random.random()) for x in range(500)]
+        expected = self.heatmap.heatmap(pts, size=(200, 200))
+        area = self.heatmap.area
+        nan, inf = float("nan"), float("inf")
+        dirty = pts + [(nan, 0.5), (0.5, inf), (-inf, nan)]
+        img = self.heatmap.heatmap(dirty, size=(200, 200))
+        self.assertEqual(self.heatmap.area, area)
+        self.assertEqual(img.tobytes(), expected.tobytes())
+
+        stats = heatmap.RenderStats()
+        self.heatmap.heatmap(dirty, size=(200, 200), finite=True,
+                             stats=stats)
+        self.assertEqual(stats.points, len(pts))
+        d = self.heatmap.density(dirty, size=(200, 200), finite=True,
+                                 weights=[1] * len(dirty))
+        self.assertEqual(d.count, len(pts))
+        self.assertRaises(Exception, self.heatmap.heatmap,
+                          [(nan, nan), (inf, 0)])
+
+        # a junk point at 0,0 no longer squeezes the rest into a corner
+        far = [(random.uniform(50, 51), random.uniform(20, 21))
+               for x in range(2000)] + [(0, 0)]
+        self.heatmap.heatmap(far, size=(200, 200), autoclip=(1, 99))
+        ((minX, minY), (maxX, maxY)) = self.heatmap.area
+        self.assertTrue(50 <= minX < 50.1 and 20 <= minY < 20.1,
+                        self.heatmap.area)
+        self.assertTrue(50.9 < maxX <= 51 and 20.9 < maxY <= 21,
+                        self.heatmap.area)
+        self.heatmap.saveKML("07-autoclip.kml")
+        self.assertTrue("<west>%2.16f</west>" % maxX in
+                        open("07-autoclip.kml").read())
+        self.assertEqual(self.heatmap.tune(far, autoclip=(0, 100)),
+                         self.heatmap.tune(far))
+        self.assertRaises(Exception, self.heatmap.heatmap, far,
+                          autoclip=(99, 1))
+
+        # however far out the junk is, the bounds are the exact quantiles
+        # of the float32 coordinates
+        for junk in [(-3.4028235e38, 20.5), (1e20, 1e20),
+                     (-3.4028235e38, 3.4028235e38)]:
+            pts = far[:-1] + [junk]
+            self.heatmap.heatmap(pts, size=(200, 200), autoclip=(1, 99))
+            expected = []
+            for axis in (0, 1):
+                coords = sorted(array.array('f', [p[axis] for p in pts]))
+                expected.append((coords[int(0.01 * (len(pts) - 1))],
+                                 coords[int(0.99 * (len(pts) - 1))]))
+            ((minX, minY), (maxX, maxY)) = self.heatmap.area
+            self.assertEqual(((minX, maxX), (minY, maxY)), tuple(expected))
+
     def test_invalid_heatmap(self):
         self.assertRaises(Exception, self.heatmap.heatmap, ([],))
 
+class TestBatch(unittest.TestCase):
+    def test_render(self):
+        hm = heatmap.Heatmap()
+        pts = [(random.random(), random.random()) for x in range(500)]
+        flat = array.array('f', [c for pt in pts for c in pt])
+        jobs = [(pts, {}),
+                (flat, {'dotsize': 30, 'size': (300, 200), 'scheme': 'fire'}),
+                (pts, {'size': (100, 100)}, "07-batch.png"),
+                (pts, {'weights': [2] * len(pts)}),
+                (pts, {'palette': True, 'scheme': 'fire', 'opacity': 200})]
+
+        results = batch.render(jobs, processes=2)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[0].img.tobytes(), hm.heatmap(pts).tobytes())
+        expected = hm.heatmap(pts, dotsize=30, size=(300, 200), scheme='fire')
+        self.assertEqual(results[1].img.tobytes(), expected.tobytes())
+        self.assertEqual(results[2].img, None)
+        self.assertEqual(Image.open("07-batch.png").size, (100, 100))
+        expected = hm.heatmap(pts, weights=[2] * len(pts))
+        self.assertEqual(results[3].img.tobytes(), expected.tobytes())
+        expected = hm.heatmap(pts, palette=True, scheme='fire', opacity=200)
+        self.assertEqual(results[4].img.mode, 'P')
+        self.assertEqual(results[4].img.tobytes(), expected.tobytes())
+        self.assertEqual(results[4].img.convert('RGBA').tobytes(),
+                         expected.convert('RGBA').tobytes())
+        for result in results:
+            self.assertTrue(result.seconds >= 0)
+
+    def test_invalid_job(self):
+        pts = [(random.random(), random.random()) for x in range(10)]
+        self.assertRaises(Exception, batch.render, [(pts, {}), ([], {})])
+        self.assertRaises(Exception, batch.render,
+                          [(pts, {'scheme': 'nonesuch'})], 1)
+
+class TestTiles(unittest.TestCase):
+    def setUp(self):
+        self.heatmap = heatmap.Heatmap()
+        # a cluster around Seattle and a few points straddling the
+        # antimeridian
+        self.pts = [(-122.3 + random.gauss(0, 0.05), 47.6 + random.gauss(0, 0.05))
+                    for x in range(2000)]
+        self.pts += [(179.99, 0.5), (-179.99, 0.5)]
+
+    def test_index(self):
+        index = tiles.TileIndex(self.heatmap, self.pts + [(0, 89)], zoom=10)
+        self.assertEqual(index.count, len(self.pts))
+        self.assertEqual(sorted(index.tiles(0)), [(0, 0)])
+        self.assertEqual(sorted(index.tiles(1)), [(0, 0), (1, 0)])
+        for x, y in index.tiles(10):
+            ((west, south), (east, north)) = tiles.tileBounds(10, x, y)
+            start, end = index._range(10, x, y)
+            for i in range(start, end):
+                self.assertTrue(west <= index.points[i * 2] <= east)
+                self.assertTrue(south <= index.points[i * 2 + 1] <= north)
+
+    def test_render(self):
+        index = tiles.TileIndex(self.heatmap, self.pts, zoom=12)
+        # multiply mode rounds after every dot, so compare against the
+        # points in the order the index stamps them in
+        pts = [(index.points[i * 2], index.points[i * 2 + 1])
+               for i in range(index.count)]
+        x, y = list(index.tiles(12))[0]
+        for z, tx, ty in ((12, x, y), (12, x + 1, y), (14, x * 4, y * 4)):
+            area = tiles.tileBounds(z, tx, ty)
+            expected = self.heatmap.density(pts, dotsize=60, size=(256, 256),
+                                            area=area, projection="web_mercator")
+            self.assertEqual(index.density(z, tx, ty, dotsize=60).tobytes(),
+                             expected.tobytes())
+        img = index.render(12, x, y, dotsize=60, scheme="fire")
+        self.assertEqual(img.size, (256, 256))
+
+        # the dot on the other side of the antimeridian reaches across
+        area = tiles.tileBounds(8, 0, 127)
+        expected = self.heatmap.density([(pt[0] - 360, pt[1]) for pt in pts] +
+                                        pts, dotsize=60, size=(256, 256),
+                                        area=area, projection="web_mercator")
+        self.assertEqual(index.density(8, 0, 127, dotsize=60).tobytes(),
+                         expected.tobytes())
+        self.assertTrue(min(bytearray(expected.tobytes())) < 0xff)
+
+        # at zoom 0 the whole world is a neighbour on either side
+        area = tiles.tileBounds(0, 0, 0)
+        expected = self.heatmap.density(
+            [(pt[0] - 360, pt[1]) for pt in pts] + pts +
+            [(pt[0] + 360, pt[1]) for pt in pts], dotsize=60, size=(256, 256),
+            area=area, projection="web_mercator")
+        d = index.density(0, 0, 0, dotsize=60)
+        self.assertEqual(d.tobytes(), expected.tobytes())
+        self.assertEqual(d.area, area)
+
+        self.assertEqual(index.render(12, 0, 0, dotsize=60), None)
+
+    def test_generate(self):
+        outdir = "10-tiles"
+        count = tiles.generate(self.pts, outdir, [3, 9], workers=2,
+                               dotsize=40, scheme="fire")
+        index = tiles.TileIndex(self.heatmap, self.pts, zoom=9)
+        written = 0
+        for z in (3, 9):
+            for x, y in index.occupied(z, 40):
+                path = os.path.join(outdir, str(z), str(x), "%d.png" % y)
+                self.assertEqual(Image.open(path).size, (256, 256))
+                written += 1
+        self.assertEqual(count, written)
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.pts = [(-122.3 + random.gauss(0, 0.05),
+                     47.6 + random.gauss(0, 0.05)) for x in range(1000)]
+        x, y = [(x, y) for x, y in
+                tiles.TileIndex(heatmap.Heatmap(), self.pts, zoom=10).tiles(10)][0]
+        self.tile = (10, x, y)
+
+    def test_tile(self):
+        cacheDir = "11-tilecache"
+        shutil.rmtree(cacheDir, True)
+        tiles_ = server.TileServer(self.pts, zoom=10, cacheDir=cacheDir,
+                                   dotsize=40)
+        data = tiles_.tile(*self.tile)
+        self.assertEqual(Image.open(StringIO(data)).size, (256, 256))
+        self.assertEqual(tiles_.tile(*self.tile), data)
+        self.assertNotEqual(tiles_.tile(*self.tile, scheme="fire"), data)
+        self.assertEqual(tiles_.tile(10, 0, 0), server.EMPTY_TILE)
+        self.assertRaises(Exception, tiles_.tile, 10, 1024, 0)
+        self.assertRaises(Exception, tiles_.tile, 10, 0, 0, scheme="nonesuch")
+        self.assertRaises(Exception, tiles_.tile, 10, 0, 0, dotsize=20000)
+        self.assertRaises(Exception, tiles_.tile, 10, 0, 0, dotsize=0)
+        self.assertRaises(Exception, tiles_.tile, 10, 0, 0, opacity=256)
+        stats = tiles_.stats()
+        self.assertEqual((stats['hits'], stats['renders'], stats['empty']),
+                         (1, 2, 1))
+        self.assertEqual(sum([count for bound, count in stats['latency']]), 2)
+
+        # a fresh server over the same points finds the tiles on disk
+        tiles_ = server.TileServer(self.pts, zoom=10, cacheDir=cacheDir,
+                                   dotsize=40)
+        self.assertEqual(tiles_.tile(*self.tile), data)
+        self.assertEqual((tiles_.stats()['diskHits'],
+                          tiles_.stats()['renders']), (1, 0))
+
+    def test_http(self):
+        tiles_ = server.TileServer(self.pts, zoom=10, dotsize=40)
+        httpd = tiles_.httpServer("127.0.0.1", 0)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d" % httpd.server_address[1]
+            data = urllib2.urlopen(url + "/%d/%d/%d.png?scheme=fire" %
+                                   self.tile).read()
+            self.assertEqual(data, tiles_.tile(*self.tile, scheme="fire"))
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              url + "/10/0/x.png")
+            for query in ("dotsize=20000", "dotsize=1000000", "opacity=-1",
+                          "opacity=300", "dotsize=big"):
+                try:
+                    urllib2.urlopen(url + "/%d/%d/%d.png?" % self.tile + query)
+                    self.fail(query)
+                except urllib2.HTTPError, e:
+                    self.assertEqual(e.code, 400)
+            stats = json.loads(urllib2.urlopen(url + "/stats").read())
+            self.assertEqual((stats['hits'], stats['renders']), (1, 1))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        lru = cache.LRUCache(maxBytes=10)
+        lru.put("a", "1234")
+        lru.put("b", "1234")
+        self.assertEqual(lru.get("a"), "1234")
+        lru.put("c", "1234")
+        self.assertEqual(lru.get("b"), None)
+        self.assertEqual(lru.get("a"), "1234")
+        self.assertEqual(lru.bytes, 8)
+        lru.put("d", "x" * 11)
+        self.assertEqual(lru.get("d"), None)
+        self.assertEqual((lru.hits, lru.misses), (2, 2))
+
+    def test_render(self):
+        cacheDir = "12-rendercache"
+        shutil.rmtree(cacheDir, True)
+        hm = heatmap.Heatmap()
+        renders = cache.RenderCache(hm, cacheDir=cacheDir)
+        pts = array.array('f', [random.random() for x in range(2000)])
+        expected = hm.heatmap(pts, dotsize=50, size=(300, 200))
+
+        img = renders.heatmap(pts, dotsize=50, size=(300, 200))
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        img = renders.heatmap(pts, size=(300, 200), dotsize=50)
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertEqual(renders.stats()['renders'], 1)
+
+        # any change to the points or the options is a different render
+        pts2 = array.array('f', pts)
+        pts2[-1] += 0.001
+        renders.heatmap(pts2, dotsize=50, size=(300, 200))
+        renders.heatmap(pts, dotsize=51, size=(300, 200))
+        renders.heatmap(pts, weights=[2] * 1000, dotsize=50, size=(300, 200))
+        self.assertEqual(renders.stats()['renders'], 4)
+        # but not the options that leave the image alone
+        stats = heatmap.RenderStats()
+        img = renders.heatmap(pts, dotsize=50, size=(300, 200), stats=stats,
+                              threads=2)
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertEqual(renders.stats()['renders'], 4)
+        # nor options passed at their defaults
+        img = renders.heatmap(pts, dotsize=50, size=(300, 200),
+                              scheme="classic", opacity=128)
+        self.assertEqual(renders.stats()['renders'], 4)
+        self.assertEqual(renders.fingerprint(pts, dotsize=50)[0],
+                         renders.fingerprint(pts, dotsize=50,
+                                             size=(1024, 1024))[0])
+
+        png = renders.png(pts, dotsize=50, size=(300, 200))
+        self.assertEqual(Image.open(StringIO(png)).tobytes(),
+                         expected.tobytes())
+        stats = renders.stats()
+        self.assertEqual((stats['hits'], stats['diskHits'], stats['renders']),
+                         (3, 1, 4))
+        self.assertEqual(stats['hitRate'], 3 / 8.0)
+        self.assertEqual(stats['entries'], 5)
+
+        # another process finds the PNGs on disk
+        renders = cache.RenderCache(hm, cacheDir=cacheDir)
+        img = renders.heatmap(pts, dotsize=50, size=(300, 200))
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertEqual(renders.stats()['renders'], 0)
+
+        # a scheme registered again with other colors is a different render
+        saved = colorschemes.schemes
+        colorschemes.schemes = dict(saved)
+        try:
+            colorschemes.register("cache-test", saved["fire"])
+            fire = renders.heatmap(pts, dotsize=50, size=(300, 200),
+                                   scheme="cache-test")
+            colorschemes.register("cache-test", saved["pbj"])
+            pbj = renders.heatmap(pts, dotsize=50, size=(300, 200),
+                                  scheme="cache-test")
+        finally:
+            colorschemes.schemes = saved
+        self.assertNotEqual(fire.tobytes(), pbj.tobytes())
+        self.assertEqual(pbj.tobytes(), hm.heatmap(
+            pts, dotsize=50, size=(300, 200), scheme="pbj").tobytes())
+        self.assertEqual(renders.stats()['renders'], 2)
+
+        # palette images keep their mode, palette and transparency
+        expected = hm.heatmap(pts, dotsize=50, size=(300, 200), palette=True)
+        for x in range(2):
+            img = renders.heatmap(pts, dotsize=50, size=(300, 200),
+                                  palette=True)
+            self.assertEqual(img.mode, 'P')
+            self.assertEqual(img.tobytes(), expected.tobytes())
+            self.assertEqual(img.convert('RGBA').tobytes(),
+                             expected.convert('RGBA').tobytes())
+        self.assertEqual(renders.stats()['renders'], 3)
+
+        # projection functions are rendered every time, even two closures
+        # of the same name
+        def power(exponent):
+            def projection(arr):
+                for i in range(len(arr)):
+                    arr[i] **= exponent
+            return projection
+
+        area = ((0, 0), (1, 1))
+        images = []
+        for exponent in (0.5, 2):
+            expected = hm.heatmap(pts, dotsize=50, size=(300, 200), area=area,
+                                  projection=power(exponent))
+            img = renders.heatmap(pts, dotsize=50, size=(300, 200), area=area,
+                                  projection=power(exponent))
+            self.assertEqual(img.tobytes(), expected.tobytes())
+            png = renders.png(pts, dotsize=50, size=(300, 200), area=area,
+                              projection=power(exponent))
+            self.assertEqual(Image.open(StringIO(png)).tobytes(),
+                             expected.tobytes())
+            images.append(img.tobytes())
+        self.assertNotEqual(images[0], images[1])
+        self.assertEqual(renders.stats()['renders'], 7)
+        self.assertRaises(Exception, renders.fingerprint, pts,
+                          projection=power(1))
+
+class TestBench(unittest.TestCase):
+    def test_points(self):
+        for distribution in bench.DISTRIBUTIONS:
+            pts = array.array('f', str(buffer(
+                bench.makePoints(500, distribution))))
+            self.assertEqual(len(pts), 1000)
+        self.assertEqual(set(pts[0::2]), set([0.5]))
+        self.assertRaises(Exception, bench.makePoints, 10, "spiral")
+
+    def test_sweep(self):
+        hm = heatmap.Heatmap()
+        results = bench.sweep(hm, [300], dotsizes=[10, 30],
+                              sizes=[(64, 48)], distributions=["uniform"],
+                              engines=["stamp", "blur"], runs=1)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual(sorted(result['stages']), sorted(bench.STAGES))
+            self.assertTrue(min(result['stages'].values()) >= 0)
+        self.assertEqual(json.loads(json.dumps(results))[3]['engine'], "blur")
+
+        out = "13-bench.json"
+        bench.main(["--points", "2e2", "--dotsize", "10", "--size", "32x16",
+                    "--runs", "1", "-o", out])
+        report = json.load(file(out))
+        self.assertEqual(len(report['results']), len(bench.DISTRIBUTIONS))
+        self.assertEqual(report['results'][0]['size'], [32, 16])
+
 class TestColorScheme(unittest.TestCase):
     def test_schemes(self):
         keys = colorschemes.valid_schemes()
@@ -79,5 +1029,37 @@ class TestColorScheme(unittest.TestCase):
                 self.assertTrue(isinstance(g, int))
                 self.assertTrue(isinstance(b, int))
 
+    def test_lut(self):
+        lut = colorschemes.rgba("fire", 200)
+        self.assertTrue(lut is colorschemes.rgba("fire", 200))
+        self.assertEqual(len(lut), 1024)
+        for level, (r, g, b) in enumerate(colorschemes.schemes["fire"]):
+            alpha = level <= 252 and 200 or 0
+            self.assertEqual(map(ord, lut[level*4:level*4+4]), [r, g, b, alpha])
+        self.assertEqual(colorschemes.rgb("fire"),
+                         "".join([lut[i*4:i*4+3] for i in range(256)]))
+
+    def test_register(self):
+        hm = heatmap.Heatmap()
+        pts = [(random.random(), random.random()) for x in range(100)]
+        saved = colorschemes.schemes
+        colorschemes.schemes = dict(saved)
+        colorschemes.register("green", [(0, 255 - x, 0) for x in range(256)])
+        try:
+            img = hm.heatmap(pts, scheme="green", opacity=255)
+            self.assertTrue("green" in hm.schemes())
+            for r, g, b, a in img.getdata():
+                self.assertEqual((r, b), (0, 0))
+                self.assertTrue(a in (0, 255))
+            # replacing a scheme drops its cached tables
+            colorschemes.register("green", [(0, 0, x) for x in range(256)])
+            img = hm.heatmap(pts, scheme="green", opacity=255)
+            self.assertEqual(img.getpixel((0, 0))[1], 0)
+        finally:
+            colorschemes.schemes = saved
+        self.assertRaises(Exception, colorschemes.register, "bad", [(0, 0, 0)])
+        self.assertRaises(Exception, colorschemes.register, "bad",
+                          [(0, 0, 256)] * 256)
+
 if __name__ == "__main__":
     unittest.main()